@@ -37,6 +37,9 @@ Dependencies:
 
 import sys
 from random import choice # for client_id generation.
+from threading import Condition, Lock, RLock, local # for sharing connections between threads.
+from functools import lru_cache # for memoizing color payloads.
+from contextlib import contextmanager # for locking the history.
 
 
 class C4Interface: # {{{1
@@ -45,6 +48,9 @@ class C4Interface: # {{{1
     broker = "autoc4.labor.koeln.ccc.de"
     port = 1883
     qos = 0
+    # Maximum number of QoS 1 messages awaiting their acknowledgement per
+    # connection. Further messages are queued until the broker catches up.
+    window = 20
     retain = True
     # Generate a (sufficiently) unique client id.
     client_id = "c4ctrl-" + "".join(
@@ -67,8 +73,444 @@ class C4Interface: # {{{1
         print(error, file=sys.stderr)
         sys.exit(1)
 
+    # Additional brokers every message is mirrored to, as (host, port)
+    # tuples. See load_config().
+    mirrors = []
+    # How pull() answers if mirrors are configured: "first" returns the first
+    # complete responce, "quorum" waits for the majority of brokers and
+    # returns the payloads most of them agree on.
+    pull_policy = "first"
+    # Persistent connections (one per broker) shared by all instances, see
+    # connect(). Brokers we could not connect to are None.
+    _clients = []
+    # Callbacks registered via subscribe() as [topic, callback, broker index]
+    # lists.
+    _subscriptions = []
+    # Last message received from the main broker by topic. Messages of topics
+    # matching a filter in _tracked are kept up to date and answer pull()s
+    # without asking the broker. See track().
+    _cache = {}
+    _tracked = []
+    # Protects _clients, _subscriptions, _cache and _tracked, which are
+    # shared by all threads.
+    _lock = RLock()
+    # Serializes connect() calls.
+    _connecting = Lock()
+    # Per thread state, eg. messages published but not yet sent.
+    _local = local()
+    # Seconds to wait for retained messages when pulling and for brokers to
+    # accept connections.
+    timeout = 10
+    # Maximum rate of messages to topics starting with a prefix, protecting
+    # the devices behind them from being flooded. {prefix: (messages per
+    # second, burst)}, see RateLimiter and load_config().
+    rate_limits = {
+        "dmx/" : (100, 40),
+        "kitchenlight/" : (4, 2)
+    }
+    # The RateLimiter shared by all threads, created on first use.
+    _limiter = None
+    # Take a snapshot before changing lights or switches, see History.
+    history = False
+
+    def _timed(self, operation, function, *args):
+        """ Returns function(*args), recording how long it took if Metrics
+            are enabled. """
+
+        if not Metrics.enabled:
+            return function(*args)
+
+        from time import monotonic
+
+        start = monotonic()
+        try:
+            return function(*args)
+        finally:
+            Metrics.observe(operation, monotonic() - start)
+
+    def _parse_endpoint(self, endpoint):
+        """ Returns a (host, port) tuple from a string "HOST[:PORT]". """
+
+        host, sep, port = endpoint.strip().partition(':')
+        return (host, int(port) if port else 1883)
+
+    def load_config(self, filename=None):
+        """ Read broker settings from "c4ctrl.conf" in the config directory.
+
+            The file may contain a section like this:
+                [broker]
+                host = autoc4.labor.koeln.ccc.de:1883
+                mirrors = mirror.example.org
+                          localhost:1884
+                pull = first (or quorum)
+                timeout = 10
+                qos = 0 (or 1)
+                window = 20
+
+            Rate limits (see rate_limits) may be set or disabled per topic
+            prefix in a section like this:
+                [rate limits]
+                dmx/ = 100 40 (messages per second and burst)
+                kitchenlight/ = off """
+
+        import configparser, os
+
+        if filename is None:
+            config_dir = ColorScheme()._get_config_dir(ignore_missing=True)
+            if not config_dir: return
+            filename = os.path.join(config_dir, "c4ctrl.conf")
+
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read(filename)
+        except configparser.Error as error:
+            print("Warning: could not parse \"{}\": {}".format(filename, error),
+                  file=sys.stderr)
+            return
+
+        if "rate limits" in parser:
+            limits = C4Interface.rate_limits.copy()
+            for prefix, value in parser["rate limits"].items():
+                if value.strip() in ("off", "0"):
+                    limits.pop(prefix, None)
+                    continue
+                try:
+                    rate, burst = (value.split() + [1])[:2]
+                    if float(rate) <= 0: raise ValueError
+                    limits[prefix] = (float(rate), max(int(burst), 1))
+                except ValueError:
+                    print("Warning: invalid rate limit \"{}\" for \"{}\" in \"{}\"!".format(
+                        value, prefix, filename), file=sys.stderr)
+            C4Interface.rate_limits = limits
+            C4Interface._limiter = None
+
+        if "broker" not in parser: return
+
+        section = parser["broker"]
+        if "host" in section:
+            C4Interface.broker, C4Interface.port = self._parse_endpoint(section["host"])
+        C4Interface.mirrors = [self._parse_endpoint(m)
+                               for m in section.get("mirrors", "").split()]
+        C4Interface.pull_policy = section.get("pull", self.pull_policy)
+        C4Interface.timeout = section.getfloat("timeout", self.timeout)
+        C4Interface.qos = section.getint("qos", self.qos)
+        C4Interface.window = section.getint("window", self.window)
+
+    def _endpoints(self):
+        """ Returns (host, port) of every broker, starting with the main one. """
+
+        return [(self.broker, self.port)] + self.mirrors
+
+    def _needed(self, count):
+        """ Returns how many of count brokers have to answer a pull(). """
+
+        if self.pull_policy == "quorum":
+            return count // 2 + 1
+        return 1
+
+    def _fan_out(self, function, wait=None):
+        """ Call function(index, host, port) for every broker concurrently.
+
+            Returns a list of the results (or exceptions raised) in the order
+            of _endpoints(). Returns as soon as <wait> calls succeeded (all
+            by default), results of unfinished calls are None. """
+
+        from threading import Thread, Condition
+
+        endpoints = self._endpoints()
+        if wait is None: wait = len(endpoints)
+        results = [None] * len(endpoints)
+        succeeded = finished = 0
+        done = Condition()
+
+        def run(index, host, port):
+            nonlocal succeeded, finished
+            try:
+                result = function(index, host, port)
+            except Exception as error:
+                result = error
+            with done:
+                results[index] = result
+                succeeded += not isinstance(result, Exception)
+                finished += 1
+                done.notify()
+
+        if len(endpoints) == 1:
+            # Nothing to parallelize.
+            run(0, *endpoints[0])
+            return results
+
+        for index, (host, port) in enumerate(endpoints):
+            Thread(target=run, args=(index, host, port), daemon=True).start()
+        with done:
+            done.wait_for(lambda: succeeded >= wait or finished == len(endpoints))
+            return results.copy()
+
+    def _check_errors(self, results, main=False):
+        """ Report exceptions in results as returned by _fan_out().
+
+            Errors are fatal if every broker failed (or the main broker did
+            and main is True). Otherwise failing mirrors only cause a
+            warning. """
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        if not errors: return
+
+        if len(errors) == len(results) or main and isinstance(results[0], Exception):
+            error = results[0] if isinstance(results[0], Exception) else errors[0]
+            if isinstance(error, PermissionError):
+                self.on_permission_error(error)
+            elif isinstance(error, OSError):
+                self.on_os_error(error)
+            raise error
+
+        endpoints = self._endpoints()
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                print("Warning: could not reach broker {}:{}: {}".format(
+                    *endpoints[index], result), file=sys.stderr)
+
+    def connect(self):
+        """ Open persistent connections to the broker(s).
+
+            Until disconnect() is called, every C4Interface will push and
+            pull using these connections instead of connecting anew on every
+            call. subscribe() requires a persistent connection. Connections
+            to all brokers are opened concurrently. """
+
+        # Don't hold _lock while connecting, on_connect() needs it.
+        with C4Interface._connecting:
+            if C4Interface._clients: return
+            self._timed("connect", self._connect)
+
+    def _refused(self, rc):
+        """ Raise the exception matching the CONNACK return code rc of a
+            broker (None if it did not answer). """
+
+        from paho.mqtt import client as mqtt
+
+        if rc is None:
+            raise TimeoutError("the broker did not accept the connection within \
+{} seconds".format(self.timeout))
+        if rc in (mqtt.CONNACK_REFUSED_BAD_USERNAME_PASSWORD,
+                  mqtt.CONNACK_REFUSED_NOT_AUTHORIZED):
+            raise PermissionError(mqtt.connack_string(rc))
+        raise ConnectionRefusedError(mqtt.connack_string(rc))
+
+    def _connect(self):
+        """ Open the connections for connect(). Call with _connecting held. """
+
+        from threading import Event
+        from paho.mqtt import client as mqtt
+
+        if self.debug:
+            return print("[DEBUG] inhibited connection to {}".format(", ".join(
+                "{}:{}".format(*e) for e in self._endpoints())), file=sys.stderr)
+
+        def open_connection(index, host, port):
+            connected = Event()
+            result = [None] # rc of the CONNACK.
+
+            def on_connect(client, userdata, flags, rc):
+                result[0] = rc
+                connected.set()
+                if rc != mqtt.CONNACK_ACCEPTED: return
+                # (Re-)subscribe to all registered topics, as subscriptions
+                # may have been lost if we had to reconnect.
+                with C4Interface._lock:
+                    topics = set(sub[0] for sub in C4Interface._subscriptions
+                                 if sub[2] == index)
+                for topic in topics:
+                    client.subscribe(topic, self.qos)
+
+            client = mqtt.Client(client_id=self.client_id, userdata=index)
+            client.max_inflight_messages_set(self.window)
+            client.on_connect = on_connect
+            client.on_message = self._on_message
+            client.on_publish = Delivery._on_publish
+            client.connect(host, port)
+            client.loop_start()
+            if not connected.wait(self.timeout) or result[0] != mqtt.CONNACK_ACCEPTED:
+                client.disconnect()
+                client.loop_stop()
+                self._refused(result[0])
+            return client
+
+        results = self._fan_out(open_connection)
+        self._check_errors(results, main=True)
+        with C4Interface._lock:
+            C4Interface._clients = [None if isinstance(r, Exception) else r
+                                    for r in results]
+
+    def disconnect(self):
+        """ Close the persistent connections opened by connect(). """
+
+        with C4Interface._lock:
+            clients = C4Interface._clients
+            C4Interface._clients = []
+            C4Interface._subscriptions = []
+            C4Interface._cache = {}
+            C4Interface._tracked = []
+        for client in clients:
+            if client:
+                client.disconnect()
+                client.loop_stop()
+
+    def _on_message(self, client, userdata, message):
+        """ Hand an incoming message to every matching subscriber. """
+
+        from paho.mqtt.client import topic_matches_sub
+
+        # userdata is the index of the broker the message came from.
+        with C4Interface._lock:
+            if userdata == 0:
+                C4Interface._cache[message.topic] = message
+            subscriptions = C4Interface._subscriptions.copy()
+        for topic, callback, index in subscriptions:
+            if index == userdata and topic_matches_sub(topic, message.topic):
+                callback(message)
+
+    def subscribe(self, topic, callback, broker=0):
+        """ Call callback(message) for every message received on topic.
+
+            topic may be a list of topics or a single topic given as string
+            and may contain wildcards. broker is the index of the broker to
+            subscribe to (0 is the main broker, mirrors follow). Requires a
+            persistent connection (see connect(), which will be called if
+            necessary). """
+
+        if type(topic) == str:
+            topic = [topic]
+
+        if self.debug:
+            return print("[DEBUG] inhibited subscription to:", topic,
+                file=sys.stderr)
+
+        self.connect()
+        with C4Interface._lock:
+            client = C4Interface._clients[broker]
+            for t in topic:
+                C4Interface._subscriptions.append([t, callback, broker])
+        # Subscriptions made while still connecting will be taken care of by
+        # on_connect().
+        if client and client.is_connected():
+            for t in topic:
+                client.subscribe(t, self.qos)
+
+    def unsubscribe(self, topic, callback, broker=0):
+        """ Stop calling callback for messages received on topic. """
+
+        if type(topic) == str:
+            topic = [topic]
+
+        unused = []
+        with C4Interface._lock:
+            if not C4Interface._clients: return
+            client = C4Interface._clients[broker]
+
+            for t in topic:
+                if [t, callback, broker] in C4Interface._subscriptions:
+                    C4Interface._subscriptions.remove([t, callback, broker])
+                # Keep the subscription if someone else is still interested.
+                if [t, broker] not in ([s[0], s[2]] for s in C4Interface._subscriptions):
+                    unused.append(t)
+
+        if client and unused:
+            client.unsubscribe(unused)
+
+    # Callback for subscriptions made by track().
+    _keep = staticmethod(lambda message: None)
+
+    def track(self, topic="#"):
+        """ Keep the state of topic (may contain wildcards) in a cache shared
+            by all threads.
+
+            pull()s of tracked topics are answered from the cache without
+            asking the broker, as long as the persistent connection is open.
+            Our own pushes invalidate cached topics until the broker confirms
+            the new state. """
+
+        if type(topic) == str:
+            topic = [topic]
+
+        self.subscribe(topic, C4Interface._keep)
+        with C4Interface._lock:
+            C4Interface._tracked.extend(topic)
+
+    def _cached(self, topic):
+        """ Returns the cached messages for all topics given or None if any
+            of them is not tracked or not known. """
+
+        from paho.mqtt.client import topic_matches_sub
+
+        with C4Interface._lock:
+            responce = []
+            for t in topic:
+                if t not in C4Interface._cache: return None
+                if not any(topic_matches_sub(f, t) for f in C4Interface._tracked):
+                    return None
+                responce.append(C4Interface._cache[t])
+
+        if len(topic) == 1:
+            return responce[0]
+        return responce
+
+    def _publish(self, messages):
+        """ Publish (topic, payload, qos, retain) tuples or dicts using the
+            persistent connections.
+
+            Messages are handed to every connection at once without waiting
+            for acknowledgements in between. Returns a Delivery. """
+
+        messages = [(m["topic"], m["payload"], m["qos"], m["retain"])
+                    if type(m) == dict else m for m in messages]
+
+        with C4Interface._lock:
+            clients = C4Interface._clients
+            # The cached state of these topics is about to change.
+            for m in messages:
+                C4Interface._cache.pop(m[0], None)
+
+        delivery = Delivery()
+        for index, client in enumerate(clients):
+            if not client: continue
+            for m in messages:
+                delivery.add(index, m[0], m[2], client.publish(*m))
+
+        # Remember what this thread published since hold(), see
+        # wait_for_publish(). Nobody else would ever forget it.
+        pending = getattr(C4Interface._local, "pending", None)
+        if pending is not None:
+            pending.extend(delivery)
+        return delivery
+
+    def wait_for_publish(self, timeout=None, delivery=None):
+        """ Wait until the messages pushed by the current thread via the
+            persistent connections since hold() (or the messages of
+            delivery, if given) have been sent (or acknowledged by the broker
+            if qos is 1).
+
+            Returns False and prints a warning listing the messages which
+            were not delivered within timeout seconds. """
+
+        if delivery is None:
+            delivery = getattr(C4Interface._local, "pending", None)
+            C4Interface._local.pending = None
+        if delivery is None or delivery.wait(timeout):
+            return True
+
+        endpoints = self._endpoints()
+        unacked = delivery.unacked()
+        for index in sorted(set(broker for broker, topic in unacked)):
+            topics = [topic for broker, topic in unacked if broker == index]
+            print("Warning: {} of {} messages not {} by broker {}:{}: {}".format(
+                len(topics), len(delivery),
+                "acknowledged" if self.qos else "sent", *endpoints[index],
+                ", ".join(sorted(set(topics)))), file=sys.stderr)
+        return False
+
     def push(self, message, topic=None, retain=None):
-        """ Send a message to the MQTT broker.
+        """ Send a message to the MQTT broker (and its mirrors).
 
             message may be a byte encoded payload or a list of either dict()s
             or tuples()s. If message is a byte encoded payload, topic= must be
@@ -76,13 +518,12 @@ class C4Interface: # {{{1
                 dict("topic": str(topic), "payload": bytes(payload))
                 tuple(str(topic), bytes(payload)) """
 
-        from paho.mqtt import publish
-
         # Skip empty messages.
         if message == [] or message == "": return
 
         # Set defaults.
         if retain == None: retain = self.retain
+        held = getattr(C4Interface._local, "held", None)
 
         if type(message) == list:
             # Add <qos> and <retain> to every message.
@@ -100,48 +541,230 @@ class C4Interface: # {{{1
                     message.remove(item)
                     message.append(new_item)
 
-            if self.debug: return print("[DEBUG] inhibited messages:",
-                message, file=sys.stderr)
+        else: # Message is not a list.
+            if self.debug and held is None:
+                return print("[DEBUG] inhibited message to '{}': '{}'".format(
+                        topic, message), file=sys.stderr)
 
-            try:
-                publish.multiple(message,
-                        hostname=self.broker,
-                        port=self.port,
-                        client_id=self.client_id)
+            message = [(topic, message, self.qos, retain)]
 
-            except PermissionError as error:
-               self.on_permission_error(error)
+        # Hold messages back until flush(), see hold().
+        if held is not None:
+            return held.extend(message)
 
-            except OSError as error:
-               self.on_os_error(error)
+        return self._timed("push", self._send, message)
 
-        else: # Message is not a list.
-            if self.debug:
-                return print("[DEBUG] inhibited message to '{}': '{}'".format(
-                        topic, message), file=sys.stderr)
+    def hold(self):
+        """ Hold back messages pushed by the current thread until flush() is
+            called, to send them as a single batch. Messages published from
+            now on are remembered until wait_for_publish(). """
 
-            try:
-                publish.single(topic,
-                        payload=message,
-                        qos=self.qos,
-                        retain=retain,
-                        hostname=self.broker,
-                        port=self.port,
-                        client_id=self.client_id)
+        C4Interface._local.held = []
+        if getattr(C4Interface._local, "pending", None) is None:
+            C4Interface._local.pending = Delivery()
 
-            except PermissionError as error:
-               self.on_permission_error(error)
+    def flush(self):
+        """ Send the messages held back since hold() as a single batch and
+            stop holding messages back. """
 
-            except OSError as error:
-               self.on_os_error(error)
+        held = getattr(C4Interface._local, "held", None)
+        C4Interface._local.held = None
+        if held:
+            return self._timed("push", self._send, held)
+
+    def _send(self, message):
+        """ Publish a list of (topic, payload, qos, retain) tuples or dicts
+            like push(). """
+
+        from paho.mqtt import publish
+
+        if self.debug:
+            print("[DEBUG] inhibited messages:", message, file=sys.stderr)
+            return print("[DEBUG] {} messages, {} bytes of payload".format(
+                len(message), sum(len(m["payload"] if type(m) == dict
+                                      else m[1] or b'') for m in message)),
+                file=sys.stderr)
 
-    def pull(self, topic=[]):
+        # Only the last of several retained messages to a topic matters.
+        message = self._coalesce(message)
+        if self.history:
+            History().record(message)
+        chunks = self._throttle(message)
+
+        if C4Interface._clients:
+            return self._publish_chunks(chunks)
+        if not chunks:
+            # Everything was merged into messages waiting for their turn.
+            return Delivery()
+
+        if self.qos or len(chunks) > 1 or chunks[0][0] > 0:
+            # publish.multiple() waits for the acknowledgement of every
+            # message before sending the next one and can not pause. Use a
+            # temporary persistent connection instead.
+            self.connect()
+            try:
+                delivery = self._publish_chunks(chunks)
+                self.wait_for_publish(self.timeout, delivery)
+            finally:
+                self.disconnect()
+            return delivery
+
+        message = [tuple(m) for m in chunks[0][1]]
+        self._check_errors(self._fan_out(
+            lambda index, host, port: publish.multiple(message,
+                    hostname=host,
+                    port=port,
+                    client_id=self.client_id)))
+
+    def _coalesce(self, messages):
+        """ Returns messages with every retained message dropped which is
+            followed by another retained message to the same topic. """
+
+        messages = [(m["topic"], m["payload"], m["qos"], m["retain"])
+                    if type(m) == dict else m for m in messages]
+        last = dict((m[0], i) for i, m in enumerate(messages) if m[3])
+        return [m for i, m in enumerate(messages)
+                if not m[3] or last[m[0]] == i]
+
+    def _throttle(self, messages):
+        """ Split messages into chunks according to the rate limits.
+
+            Returns a list of (delay, messages) tuples, where delay is the
+            number of seconds from now after which the chunk may be sent.
+            Chunks keep the order of messages. Retained messages merged into
+            ones still waiting to be sent (see RateLimiter.queue()) are left
+            out. """
+
+        with C4Interface._lock:
+            if C4Interface._limiter is None:
+                C4Interface._limiter = RateLimiter(self.rate_limits)
+            limiter = C4Interface._limiter
+
+        chunks = []
+        for delay, m in limiter.queue([list(m) for m in messages]):
+            if chunks and chunks[-1][0] == delay:
+                chunks[-1][1].append(m)
+            else:
+                chunks.append((delay, [m]))
+        return chunks
+
+    def _publish_chunks(self, chunks):
+        """ Publish chunks as returned by _throttle() using the persistent
+            connections, waiting for each one's turn. Returns a Delivery. """
+
+        from time import monotonic, sleep
+
+        start = monotonic()
+        delivery = Delivery()
+        for delay, messages in chunks:
+            wait = start + delay - monotonic()
+            if wait > 0: sleep(wait)
+            if C4Interface._limiter:
+                C4Interface._limiter.sent(messages)
+            delivery.extend(self._publish(messages))
+        return delivery
+
+    def _resolve(self, responces, topic):
+        """ Merge the responces (lists of messages) of several brokers to a
+            pull() according to pull_policy. """
+
+        if len(responces) == 1:
+            return responces[0]
+
+        result = []
+        for t in topic:
+            candidates = [m for r in responces for m in r if m.topic == t]
+            if candidates:
+                # Return the payload most brokers agree on.
+                payloads = [m.payload for m in candidates]
+                result.append(max(candidates, key=lambda m: payloads.count(m.payload)))
+        return result
+
+    def _query(self, host, port, topic, timeout):
+        """ Returns the retained messages of topics (a list) a broker sends
+            within timeout seconds. """
+
+        from threading import Condition
+        from paho.mqtt import client as mqtt
+
+        received = {}
+        done = Condition()
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == mqtt.CONNACK_ACCEPTED:
+                client.subscribe([(t, self.qos) for t in topic])
+            with done:
+                received[None] = rc
+                done.notify()
+
+        def on_message(client, userdata, message):
+            with done:
+                received[message.topic] = message
+                done.notify()
+
+        client = mqtt.Client(client_id=self.client_id)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(host, port)
+        client.loop_start()
+        try:
+            with done:
+                done.wait_for(lambda: all(t in received for t in topic)
+                              or received.get(None, 0) != 0, timeout)
+                rc = received.get(None)
+                messages = [received[t] for t in topic if t in received]
+        finally:
+            client.disconnect()
+            client.loop_stop()
+        if rc is not None and rc != mqtt.CONNACK_ACCEPTED:
+            self._refused(rc)
+        return messages
+
+    def _pull_persistent(self, topic, timeout=None):
+        """ Like pull(), but using the persistent connections. """
+
+        from threading import Condition
+
+        brokers = [i for i, client in enumerate(C4Interface._clients) if client]
+        received = dict((i, {}) for i in brokers)
+        complete = [] # Brokers which answered for every topic.
+        done = Condition()
+
+        def collector(index):
+            def collect(message):
+                with done:
+                    received[index][message.topic] = message
+                    if len(received[index]) >= len(topic) and index not in complete:
+                        complete.append(index)
+                        done.notify()
+            return collect
+
+        collectors = dict((i, collector(i)) for i in brokers)
+        for i in brokers:
+            self.subscribe(topic, collectors[i], broker=i)
+        with done:
+            done.wait_for(lambda: len(complete) >= self._needed(len(brokers)),
+                          self.timeout if timeout is None else timeout)
+            # Fall back to the most complete answer on timeout.
+            answered = complete.copy() or [max(brokers, key=lambda i: len(received[i]))]
+            responces = [[received[i][t] for t in topic if t in received[i]]
+                         for i in answered]
+        for i in brokers:
+            self.unsubscribe(topic, collectors[i], broker=i)
+
+        responce = self._resolve(responces, topic)
+        if len(topic) == 1:
+            # Nothing if we gave up waiting.
+            return responce[0] if responce else None
+        return responce
+
+    def pull(self, topic=[], timeout=None):
         """ Return the state of a topic.
 
             topic may be a list of topics or a single topic given as string.
-            Returns a paho message object or list of message objects. """
-
-        from paho.mqtt import subscribe
+            Returns a paho message object or list of message objects. Gives
+            up after timeout seconds (self.timeout by default), returning the
+            messages received until then (None for a single topic). """
 
         # Convert topics of type string to a single item list.
         if type(topic) == str:
@@ -154,19 +777,29 @@ class C4Interface: # {{{1
             print("[DEBUG] inhibited query for:", topic, file=sys.stderr)
             return []
 
-        try:
-            return subscribe.simple(topic,
-                    msg_count=len(topic),
-                    qos=self.qos,
-                    hostname=self.broker,
-                    port=self.port,
-                    client_id=self.client_id)
+        return self._timed("pull", self._pull, topic, timeout)
 
-        except PermissionError as error:
-           self.on_permission_error(error)
+    def _pull(self, topic, timeout=None):
+        """ Query topics (a list) for pull(). """
 
-        except OSError as error:
-           self.on_os_error(error)
+        if timeout is None: timeout = self.timeout
+
+        if C4Interface._clients:
+            responce = self._cached(topic)
+            if responce is not None:
+                return responce
+            return self._pull_persistent(topic, timeout)
+
+        def query(index, host, port):
+            return self._query(host, port, topic, timeout)
+
+        results = self._fan_out(query, wait=self._needed(len(self._endpoints())))
+        self._check_errors(results)
+        responce = self._resolve([r for r in results if type(r) == list], topic)
+        if len(topic) == 1:
+            # Nothing if we gave up waiting.
+            return responce[0] if responce else None
+        return responce
 
     def status(self):
         """ Returns current status (string "open" or "closed") of the club. """
@@ -179,6 +812,10 @@ class C4Interface: # {{{1
                 file=sys.stderr)
             class club_status: pass
             club_status.payload = b'\x00'
+        elif club_status is None:
+            print("Error: the broker did not tell the club status within {} \
+seconds!".format(self.timeout), file=sys.stderr)
+            sys.exit(1)
 
         if club_status.payload == b'\x01':
             return "open"
@@ -208,6 +845,306 @@ class C4Interface: # {{{1
         self.push(payload, topic="club/shutdown", retain=False)
 # }}}1
 
+class Delivery: # {{{1
+    """ Outcome of publishing a batch of messages via the persistent
+        connections, somewhat like a future.
+
+        A message published with QoS 1 is delivered once the broker has
+        acknowledged it, one published with QoS 0 as soon as it has been
+        sent. """
+
+    # Notified whenever any connection has delivered a message.
+    _published = Condition()
+    # Number of messages delivered, to notice deliveries while not waiting.
+    _acks = 0
+
+    def __init__(self):
+        # (broker index, topic, qos, paho MQTTMessageInfo) of every message.
+        self.messages = []
+        # Messages before this index are known to be delivered or failed.
+        self._checked = 0
+
+    @classmethod
+    def _on_publish(cls, client, userdata, mid):
+        """ on_publish callback of the persistent connections. """
+
+        with cls._published:
+            cls._acks += 1
+            cls._published.notify_all()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, broker, topic, qos, info):
+        self.messages.append((broker, topic, qos, info))
+
+    def extend(self, other):
+        self.messages.extend(other.messages)
+
+    def _pending(self, qos, info):
+        """ Returns True if a message may still be delivered. """
+
+        from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+        if info.is_published(): return False
+        # paho keeps QoS 1 messages published while disconnected and sends
+        # them after reconnecting. Other errors are final.
+        return info.rc == MQTT_ERR_SUCCESS or (qos and info.rc == MQTT_ERR_NO_CONN)
+
+    def done(self):
+        """ Returns True if every message has been delivered or failed. """
+
+        # Messages are mostly delivered in order, so only look at the first
+        # one which may still be pending.
+        while self._checked < len(self.messages):
+            broker, topic, qos, info = self.messages[self._checked]
+            if self._pending(qos, info): return False
+            self._checked += 1
+        return True
+
+    def wait(self, timeout=None):
+        """ Wait up to timeout seconds for every message to be delivered.
+
+            Returns True if all of them have been delivered. """
+
+        from time import monotonic
+
+        deadline = timeout is not None and monotonic() + timeout
+        acks = None
+        with Delivery._published:
+            while not self.done():
+                # paho marks a message as published right after calling
+                # on_publish, so look again soon after a delivery. Otherwise
+                # sleep until the next one, checking once a second anyway.
+                wait = 1 if acks == Delivery._acks else 0.001
+                acks = Delivery._acks
+                if deadline:
+                    if monotonic() > deadline: break
+                    wait = min(wait, max(deadline - monotonic(), 0))
+                Delivery._published.wait(wait)
+        return not self.unacked()
+
+    def unacked(self):
+        """ Returns (broker index, topic) of every message not delivered
+            (yet). """
+
+        return [(broker, topic) for broker, topic, qos, info in self.messages
+                if not info.is_published()]
+# }}}1
+
+class RateLimiter: # {{{1
+    """ Token buckets limiting the rate of messages by topic prefix.
+
+        Every bucket holds up to <burst> tokens and regains <rate> tokens per
+        second. Every message takes a token from the bucket of the longest
+        prefix matching its topic. Buckets may run into debt: a message has
+        to wait until its token would have been available, so bursts are
+        smoothed out to the maximum rate instead of being dropped. Retained
+        messages waiting for their turn are updated in place by later ones
+        to the same topic, so the debt only grows with the number of topics,
+        not with the number of updates. """
+
+    def __init__(self, limits):
+        # {prefix: [rate, burst, tokens, time of last update]}
+        self.buckets = dict((prefix, [float(rate), burst, burst, None])
+                            for prefix, (rate, burst) in limits.items())
+        # Delayed retained messages not sent yet by topic, see queue().
+        self.pending = {}
+        # Buckets are shared by all threads.
+        self._lock = Lock()
+
+    def _bucket(self, topic):
+        """ Returns the bucket for topic or None if it is not limited. """
+
+        prefixes = [p for p in self.buckets if topic.startswith(p)]
+        if not prefixes: return None
+        return self.buckets[max(prefixes, key=len)]
+
+    def schedule(self, topics):
+        """ Take a token for a message to every topic.
+
+            Returns a list of delays in seconds from now after which the
+            messages may be sent. Delays never decrease, so messages keep
+            their order. """
+
+        with self._lock:
+            return self._schedule(topics)
+
+    def _schedule(self, topics):
+        """ schedule() for callers holding the lock. """
+
+        from time import monotonic
+
+        delays = []
+        delay = 0
+        now = monotonic()
+        for topic in topics:
+            bucket = self._bucket(topic)
+            if bucket:
+                rate, burst, tokens, updated = bucket
+                if updated is not None:
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                tokens -= 1
+                bucket[2:] = [tokens, now]
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+            delays.append(delay)
+        return delays
+
+    def queue(self, messages):
+        """ Schedule messages, [topic, payload, qos, retain] lists.
+
+            A retained message to a topic a delayed retained message is still
+            pending for replaces the payload of that one instead of taking a
+            token. Returns a list of (delay, message) tuples like schedule()
+            for the other messages. Delayed retained messages stay pending
+            until sent() is called for them. """
+
+        with self._lock:
+            waiting = []
+            for m in messages:
+                queued = self.pending.get(m[0]) if m[3] else None
+                if queued is not None:
+                    queued[1:3] = m[1:3]
+                else:
+                    waiting.append(m)
+            delays = self._schedule(m[0] for m in waiting)
+            for m, delay in zip(waiting, delays):
+                if m[3] and delay > 0:
+                    self.pending[m[0]] = m
+        return list(zip(delays, waiting))
+
+    def sent(self, messages):
+        """ Stop replacing the payload of messages, they are being sent. """
+
+        with self._lock:
+            for m in messages:
+                if self.pending.get(m[0]) is m:
+                    del self.pending[m[0]]
+# }}}1
+
+class Metrics: # {{{1
+    """ Histograms of the time c4ctrl operations (push, pull, connect) take,
+        shared by all threads. Only recorded if enabled, see Exporter. """
+
+    enabled = False
+    # Upper bounds of the histogram buckets in seconds.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    # {operation: [count per bucket..., count above all buckets, sum]}
+    _histograms = {}
+    # Incremented on every observation, to notice changes cheaply.
+    version = 0
+    _lock = Lock()
+
+    @classmethod
+    def observe(cls, operation, seconds):
+        """ Record that operation took seconds. """
+
+        with cls._lock:
+            histogram = cls._histograms.setdefault(operation,
+                [0] * (len(cls.buckets) + 1) + [0.0])
+            index = len(cls.buckets)
+            for i, bound in enumerate(cls.buckets):
+                if seconds <= bound:
+                    index = i
+                    break
+            histogram[index] += 1
+            histogram[-1] += seconds
+            cls.version += 1
+
+    @classmethod
+    def exposition(cls, name):
+        """ Returns the histograms in the Prometheus text format as list of
+            lines, using metric name. """
+
+        lines = ["# HELP {} Time taken by c4ctrl operations.".format(name),
+                 "# TYPE {} histogram".format(name)]
+        with cls._lock:
+            histograms = dict((o, h.copy()) for o, h in cls._histograms.items())
+        for operation in sorted(histograms):
+            histogram = histograms[operation]
+            count = 0
+            for bound, n in zip(cls.buckets + ("+Inf",), histogram):
+                count += n
+                lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(
+                    name, operation, bound, count))
+            lines.append('{}_sum{{operation="{}"}} {}'.format(
+                name, operation, histogram[-1]))
+            lines.append('{}_count{{operation="{}"}} {}'.format(
+                name, operation, count))
+        return lines
+# }}}1
+
+class Histogram: # {{{1
+    """ Latencies in a HDR style histogram: buckets are exact for small
+        values and grow with the magnitude of the value, keeping the relative
+        error below 1/2**(precision-1) at any scale. Only buckets in use are
+        stored. """
+
+    # Bits of each value kept exactly.
+    precision = 8
+
+    def __init__(self):
+        self.counts = {} # {lowest value of the bucket: count}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def _bucket(self, value):
+        """ Returns (lowest, highest) value of the bucket value falls into. """
+
+        shift = max(0, value.bit_length() - self.precision)
+        lowest = value >> shift << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def record(self, seconds):
+        """ Record a latency of seconds (with microsecond resolution). """
+
+        value = max(0, round(seconds * 1000000))
+        lowest = self._bucket(value)[0]
+        self.counts[lowest] = self.counts.get(lowest, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def percentile(self, percent):
+        """ Returns the latency in seconds <percent> percent of all values
+            are equal or below of, or None if nothing was recorded. """
+
+        if not self.count: return None
+        from math import ceil
+
+        rank = max(1, ceil(percent / 100 * self.count))
+        seen = 0
+        for lowest in sorted(self.counts):
+            seen += self.counts[lowest]
+            if seen >= rank:
+                # Like HdrHistogram, report the highest equivalent value.
+                highest = self._bucket(lowest)[1]
+                return min(max(highest, self.min), self.max) / 1000000
+        return self.max / 1000000
+
+    def mean(self):
+        """ Returns the mean latency in seconds or None. """
+
+        return self.count and self.total / self.count / 1000000 or None
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """ Returns min, the percentiles and max in milliseconds as text. """
+
+        if not self.count: return "no samples"
+        values = [("min", self.min / 1000000)]
+        values.extend(("p{}".format(p), self.percentile(p)) for p in percentiles)
+        values.append(("max", self.max / 1000000))
+        return "  ".join("{} {:.2f}".format(name, value * 1000)
+                         for name, value in values) + " ms"
+# }}}1
+
 class Kitchenlight: # {{{1
     """ Interface to the Kitchenlight and its functions. """
     # TODO: use struct(?)
@@ -225,6 +1162,21 @@ class Kitchenlight: # {{{1
         "flood",
         "clock"
     ]
+    # Names of screens by their ID (the first 4 bytes of a payload).
+    screens = {
+        0 : "off",
+        1 : "checker",
+        2 : "matrix",
+        3 : "mood",
+        4 : "oc",
+        5 : "pacman",
+        6 : "sine",
+        7 : "strobo",
+        8 : "text",
+        9 : "flood",
+        11 : "clock",
+        12 : "life"
+    }
     _END = "little" # Kitchenlight endianess.
 
     def __init__(self, topic="kitchenlight/change_screen",
@@ -268,6 +1220,20 @@ class Kitchenlight: # {{{1
         # Fallback.
         return name
 
+    def describe(self, payload):
+        """ Returns a short description of the mode set by payload. """
+
+        if len(payload) < 4:
+            return "unknown"
+
+        screen = int.from_bytes(payload[0:4], self._END)
+        mode = self.screens.get(screen, "screen {}".format(screen))
+        if mode == "text":
+            # The text is terminated by a null byte.
+            text = bytes(payload[8:]).split(b'\x00')[0]
+            mode += " \"{}\"".format(text.decode("ascii", "replace"))
+        return mode
+
     def list_available(self):
         """ Print a list of available Kitchenlight modes. """
 
@@ -332,9 +1298,8 @@ class Kitchenlight: # {{{1
             colA = first color (default 0000ff)
             colB = second color (default 00ff00) """
 
-        # Kind of a hack: lets treat the two colors as DMX lights.
-        ca = Dmx("checker/a", colA.lstrip('#'))
-        cb = Dmx("checker/b", colB.lstrip('#'))
+        ca = Color().payload(colA)
+        cb = Color().payload(colB)
         d = bytearray(20)
         v = memoryview(d)
         # Screen 1
@@ -342,13 +1307,13 @@ class Kitchenlight: # {{{1
         # Delay
         v[4:8] = int(delay).to_bytes(4, self._END)
         # ColorA R/G/B
-        v[8:10] = int(ca.color[0:2], base=16).to_bytes(2, self._END)
-        v[10:12] = int(ca.color[2:4], base=16).to_bytes(2, self._END)
-        v[12:14] = int(ca.color[4:6], base=16).to_bytes(2, self._END)
+        v[8:10] = ca[0].to_bytes(2, self._END)
+        v[10:12] = ca[1].to_bytes(2, self._END)
+        v[12:14] = ca[2].to_bytes(2, self._END)
         # ColorB R/G/B
-        v[14:16] = int(cb.color[0:2], base=16).to_bytes(2, self._END)
-        v[16:18] = int(cb.color[2:4], base=16).to_bytes(2, self._END)
-        v[18:20] = int(cb.color[4:6], base=16).to_bytes(2, self._END)
+        v[14:16] = cb[0].to_bytes(2, self._END)
+        v[16:18] = cb[1].to_bytes(2, self._END)
+        v[18:20] = cb[2].to_bytes(2, self._END)
         self._switch(d)
 
     def matrix(self, lines=8):
@@ -466,54 +1431,214 @@ class Kitchenlight: # {{{1
         self._switch(d)
 # }}}1
 
-class Dmx: # {{{1
-    """ Abstraction of the 3 channel LED cans. """
+class KitchenFont: # {{{1
+    """ Font model of the Kitchenlight.
+
+        Knows the width of every character the Kitchenlight can display and
+        may be used to calculate how long a text will take to scroll by. """
+
+    columns = 30 # Width of the display.
+    spacing = 1 # Empty columns following every character.
+    default_width = 3 # Width of characters not listed in <widths>.
+
+    # Width of characters (in columns, without spacing).
+    widths = {
+        ' ' : 3, '!' : 1, '"' : 3, '#' : 5, '$' : 5, '%' : 5, '&' : 5,
+        '\'' : 1, '(' : 2, ')' : 2, '*' : 5, '+' : 5, ',' : 2, '-' : 3,
+        '.' : 2, '/' : 5, '0' : 5, '1' : 4, '2' : 5, '3' : 5, '4' : 5,
+        '5' : 5, '6' : 5, '7' : 5, '8' : 5, '9' : 5, ':' : 2, ';' : 2,
+        '<' : 3, '=' : 3, '>' : 4, '?' : 3, '@' : 5, 'A' : 5, 'B' : 5,
+        'C' : 5, 'D' : 5, 'E' : 5, 'F' : 5, 'G' : 5, 'H' : 5, 'I' : 5,
+        'J' : 5, 'K' : 5, 'L' : 5, 'M' : 5, 'N' : 5, 'O' : 5, 'P' : 5,
+        'Q' : 5, 'R' : 5, 'S' : 5, 'T' : 5, 'U' : 5, 'V' : 5, 'W' : 5,
+        'X' : 5, 'Y' : 5, 'Z' : 5, '[' : 2, '\\' : 5, ']' : 2, '^' : 3,
+        '_' : 5, '`' : 2, 'a' : 5, 'b' : 4, 'c' : 3, 'd' : 4, 'e' : 4,
+        'f' : 3, 'g' : 3, 'h' : 3, 'i' : 1, 'j' : 2, 'k' : 3, 'l' : 3,
+        'm' : 5, 'n' : 4, 'o' : 3, 'p' : 3, 'q' : 3, 'r' : 3, 's' : 4,
+        't' : 3, 'u' : 3, 'v' : 3, 'w' : 5, 'x' : 3, 'y' : 3, 'z' : 3,
+        '{' : 3, '|' : 1, '}' : 3, '~' : 5, '\t' : 5
+    }
 
-    # 3 bytes for color, one each for red, green and blue.
-    template = "000000"
+    def __init__(self):
+        # Translation table mapping every byte to the number of columns it
+        # occupies (including spacing). This lets bytes.translate() and sum()
+        # do the work in C instead of looping over characters in Python.
+        table = bytearray([self.default_width + self.spacing]) * 128
+        table.extend(bytes(128)) # Non-ASCII bytes can not be displayed.
+        for char, width in self.widths.items():
+            table[ord(char)] = width + self.spacing
+        self._table = bytes(table)
+
+    def width(self, text):
+        """ Returns the width of text in columns.
+
+            Characters the Kitchenlight can not display are ignored. The
+            spacing after the last character is not included. """
+
+        if type(text) == str:
+            text = text.encode("ascii", "ignore")
+        columns = sum(text.translate(self._table))
+        return max(columns - self.spacing, 0)
+
+    def scroll_time(self, text, delay=250):
+        """ Returns the time (in seconds) text takes to scroll by.
+
+            The text enters the display on the right and has to traverse all
+            of its columns plus its own width, each step taking <delay> ms. """
+
+        return (self.columns + self.width(text)) * delay / 1000
+
+    def render(self, text):
+        """ Returns an ASCII-art strip of text as it is laid out on the
+            Kitchenlight.
+
+            Every column of a character is drawn using the character itself
+            (or '.' for blanks), spacing columns are drawn as ' '. """
+
+        text = text.encode("ascii", "ignore").decode("ascii")
+        strip = []
+        for char in text:
+            width = self.widths.get(char, self.default_width)
+            glyph = char if char.isprintable() and char != ' ' else '.'
+            strip.append(glyph * width + ' ' * self.spacing)
+        return "".join(strip)[:self.width(text)]
+
+    def preview(self, text, step=0):
+        """ Returns an ASCII-art view of the display after <step> columns
+            of text have scrolled in. """
+
+        strip = ' ' * self.columns + self.render(text) + ' ' * self.columns
+        return "|" + strip[step:step + self.columns] + "|"
+# }}}1
 
-    def __init__(self, topic, color=None):
-        self.topic = topic
-        self.set_color(color or self.template)
-        self.is_master = topic.rfind("/master") == len(topic)-7 # 7 = len("/master")
+class Color: # {{{1
+    """ Conversion of color notations into payloads for LED cans.
+
+        Understands hex codes (eg. "ff0066" or the short form "f06"),
+        "rgb(R,G,B)" (0-255), "hsv(H,S,V)" (hue in degrees, saturation and
+        value in percent) and color names. Payloads are memoized by
+        notation and template, the least recently used ones are dropped once
+        the cache holds _CACHE_SIZE payloads. """
+
+    names = {
+        "black" : b'\x00\x00\x00',
+        "white" : b'\xff\xff\xff',
+        "red" : b'\xff\x00\x00',
+        "green" : b'\x00\xff\x00',
+        "blue" : b'\x00\x00\xff',
+        "yellow" : b'\xff\xff\x00',
+        "cyan" : b'\x00\xff\xff',
+        "magenta" : b'\xff\x00\xff',
+        "orange" : b'\xff\x66\x00',
+        "pink" : b'\xff\x00\x66',
+        "purple" : b'\x66\x00\xff',
+        "warmwhite" : b'\xff\x99\x33',
+        "coldwhite" : b'\x99\xcc\xff'
+    }
+
+    # Translation table doubling every hex digit, expanding eg. "f06" to
+    # "ff0066" in a single call to str.translate().
+    _double = str.maketrans({c: c * 2 for c in "0123456789abcdefABCDEF"})
+
+    # Number of payloads to memoize.
+    _CACHE_SIZE = 1024
+
+    def payload(self, color, template="000000"):
+        """ Returns color as payload (bytes) fitting template.
+
+            template is the hex notation of the default payload of a light
+            (see Dmx.template). Hex codes of 3 chars or half the length of
+            template are expanded (eg. #f0f), too short payloads are padded
+            with template and too long ones are silently truncated.
+            Raises ValueError if color can not be parsed. """
+
+        return self._compile(color, template)
+
+    def is_valid(self, color):
+        """ Returns True if color can be parsed. """
+
+        try:
+            self.payload(color)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    @lru_cache(maxsize=_CACHE_SIZE)
+    def _compile(color, template):
+        """ Compile color into a payload fitting template. """
+
+        color = color.strip().lstrip('#')
+        lower = color.lower()
+
+        if lower and not lower.strip("0123456789abcdef"):
+            # Hex code.
+            if len(color) > len(template):
+                # Silently truncate bytes exceeding template length.
+                color = color[:len(template)]
+            # Expand 3 char codes and codes of half the required length.
+            # Yet, let's presume that a 6-char code is alway meant to be
+            # interpreted as a color and should never be expanded.
+            elif len(color) != 6 and len(color) == 3 or len(color) == (len(template) / 2):
+                color = color.translate(Color._double)
+            if len(color) % 2:
+                # Pad odd codes in hex notation to keep them aligned.
+                color = color + template[len(color):]
+            data = bytes.fromhex(color)
+
+        elif lower in Color.names:
+            data = Color.names[lower]
+
+        elif lower[:4] in ("rgb(", "hsv(") and lower[-1:] == ")":
+            values = [float(v.strip().rstrip('%')) for v in lower[4:-1].split(',')]
+            if len(values) != 3:
+                raise ValueError("expected 3 values in \"{}\"".format(color))
+            if lower[:3] == "hsv":
+                from colorsys import hsv_to_rgb
+                values = [c * 255 for c in hsv_to_rgb(
+                    values[0] / 360 % 1, values[1] / 100, values[2] / 100)]
+            data = bytes(min(max(round(c), 0), 255) for c in values)
 
-    def _pad_color(self, color):
-        """ Merge hex color values or payloads into the template.
+        else:
+            raise ValueError("invalid color \"{}\"".format(color))
 
-            Expand 4 bit hex code notation (eg. #f0f) and pad with template
-            to get a fitting payload for this kind of light. """
+        # Pad with template.
+        template = bytes.fromhex(template)
+        return data[:len(template)] + template[len(data):]
+# }}}1
 
-        if len(color) > len(self.template):
-            # Silently truncate bytes exceeding template length.
-            return color[:len(self.template)]
+class Dmx: # {{{1
+    """ Abstraction of the 3 channel LED cans.
 
-        # Expand 3 char codes and codes of half the required length.
-        # Yet, let's presume that a 6-char code is alway meant to be
-        # interpreted as a color and should never be expanded.
-        if len(color) != 6 and len(color) == 3 or len(color) == (len(self.template) / 2):
-            color = "".join(char*2 for char in color)
+        Instances are immutable and may be shared freely. The state of the
+        lights of a room is kept by C4Room instances. """
 
-        if len(color) == len(self.template): # Nothing more to do.
-            return color
+    __slots__ = ("topic", "is_master")
+    # 3 bytes for color, one each for red, green and blue.
+    template = "000000"
 
-        # Add padding.
-        color = color + self.template[len(color):]
-        return color
+    def __init__(self, topic):
+        object.__setattr__(self, "topic", topic)
+        object.__setattr__(self, "is_master",
+                           topic.rfind("/master") == len(topic)-7) # 7 = len("/master")
 
-    def set_color(self, color):
-        """ Set color (hex) for this instance.
+    def __setattr__(self, name, value):
+        raise AttributeError("Dmx objects are immutable")
 
-            The color is then available via its color variable. """
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.topic)
 
-        color = self._pad_color(color)
+    def payload(self, color):
+        """ Returns color (see Color for valid notations) as payload (bytes)
+            for this light. """
 
-        self.color = color
-        self.payload = bytearray.fromhex(color)
+        return Color().payload(color, self.template)
 # }}}1
 
 class Dmx4(Dmx): # {{{1
     """ Abstraction of the 4 channel LED cans. """
 
+    __slots__ = ()
     # 3 bytes for color plus 1 byte for brightness.
     template = "000000ff"
 # }}}1
@@ -521,6 +1646,7 @@ class Dmx4(Dmx): # {{{1
 class Dmx7(Dmx): # {{{1
     """ Abstraction of the 7 channel LED cans. """
 
+    __slots__ = ()
     # 3 bytes for color, another 3 bytes for special functions and 1 byte
     # for brightness.
     template = "000000000000ff"
@@ -531,9 +1657,13 @@ class C4Room: # {{{1
 
     def __init__(self):
         self.c4 = C4Interface()
+        # Payloads last set by colorscheme_commands(), in the order of
+        # <lights>.
+        self.payloads = [None] * len(self.lights)
         # get_switch_state() will store its result and a timestamp to reduce
         # requests to the broker.
         self._switch_state = ("", 0.0)
+        self._lock = RLock()
 
     def _interactive_light_switch(self):
         """ Interactively ask for input.
@@ -566,30 +1696,36 @@ class C4Room: # {{{1
 
         from time import time
 
-        # We store switch states in self._switch_state to reduce requests to
-        # the broker. If this variable is neither empty nor too old, use it!
-        if self._switch_state[0] != "":
-            if time() - self._switch_state[1] <= max_age:
-                return self._switch_state[0]
-
-        state = ""
-        req = []
-        for topic in self.switches:
-            req.append(topic[1])
-        responce = self.c4.pull(req)
-
-        for sw in self.switches:
-            for r in responce:
-                if r.topic == sw[1]:
-                    state += str(int.from_bytes(r.payload, sys.byteorder))
+        with self._lock: # Instances may be shared between threads.
+            # We store switch states in self._switch_state to reduce requests
+            # to the broker. If this variable is neither empty nor too old,
+            # use it!
+            if self._switch_state[0] != "":
+                if time() - self._switch_state[1] <= max_age:
+                    return self._switch_state[0]
+
+            state = ""
+            req = []
+            for topic in self.switches:
+                req.append(topic[1])
+            responce = self.c4.pull(req)
+
+            for sw in self.switches:
+                for r in responce:
+                    if r.topic == sw[1]:
+                        state += str(int.from_bytes(r.payload, sys.byteorder))
 
-        if C4Interface.debug:
-            print("[DEBUG] Warning: handing over fake data to allow for further execution!",
-                file=sys.stderr)
-            state = '0' * len(self.switches)
+            if C4Interface.debug:
+                print("[DEBUG] Warning: handing over fake data to allow for further execution!",
+                    file=sys.stderr)
+                state = '0' * len(self.switches)
+            elif len(state) != len(self.switches):
+                print("Error: the broker did not tell the state of every switch in \
+{} within {} seconds!".format(self.name, self.c4.timeout), file=sys.stderr)
+                sys.exit(1)
 
-        self._switch_state = (state, time())
-        return state
+            self._switch_state = (state, time())
+            return state
 
     def _parse_switch_input(self, userinput):
         """ Parse user input to the switch command. """
@@ -707,22 +1843,62 @@ class C4Room: # {{{1
 
         return self.c4.push(command)
 
-    def set_colorscheme(self, colorscheme):
-        """ Apply colorscheme to the LED Cans in this room. """
+    def colorscheme_commands(self, colorscheme):
+        """ Returns the messages needed to apply colorscheme to the LED cans
+            in this room. """
 
         command = []
-        for light in self.lights:
-            if colorscheme.get_color_for(light.topic):
+        with self._lock: # Instances may be shared between threads.
+            for i, light in enumerate(self.lights):
+                color = colorscheme.get_color_for(light.topic)
+                if color:
+                    # Remember the state of this light.
+                    self.payloads[i] = light.payload(color)
+
+                    # Send data to lanterns.
+                    command.append({
+                        "topic" : light.topic,
+                        "payload" : self.payloads[i]
+                    })
+
+        return self._resolve_master(command)
+
+    def _resolve_master(self, command):
+        """ Make use of the master topic in command, to change all lights of
+            the room at once.
+
+            The master topic overrides every other light in a room. If it is
+            part of command, the colors of all other lights are replaced by
+            the color of the master. If every other light in this room is set
+            to the same color, the master is used as well. The topics of the
+            other lights keep their payloads though, and they are what
+            everyone reading the state of the room sees. So they follow the
+            master message, with its payload. """
+
+        if self.master is None or command == []:
+            return command
+
+        master = [c for c in command if c["topic"] == self.master.topic]
+        if not master:
+            # Are all lights (but the master) set to the same color?
+            if len(command) != len(self.lights) - 1: return command
+            payload = command[0]["payload"]
+            for c in command:
+                if c["payload"] != payload: return command
+            master = [{
+                "topic" : self.master.topic,
+                "payload" : payload
+            }]
+
+        return master + [{
+            "topic" : light.topic,
+            "payload" : master[0]["payload"]
+        } for light in self.lights if not light.is_master]
 
-                # Update internal state of this Dmx object, so we can query
-                # <object>.payload later.
-                light.set_color(colorscheme.get_color_for(light.topic))
+    def set_colorscheme(self, colorscheme):
+        """ Apply colorscheme to the LED Cans in this room. """
 
-                # Send data to lanterns.
-                command.append({
-                    "topic" : light.topic,
-                    "payload" : light.payload
-                })
+        command = self.colorscheme_commands(colorscheme)
 
         # Nothing to do. May happen if a preset defines no color for a room.
         if command == []: return
@@ -822,16 +1998,30 @@ class ColorScheme: # {{{1
     # Names of virtual presets. These are always listed as available and the
     # user may not save presets under this name.
     _virtual_presets = ["off", "random"]
+    # Names of files in the config directory which are not presets.
+    _reserved = ["config", "c4ctrl.conf", "presets.c4lib", "schedule",
+                 "schedule.state"]
+    # Notations of generated color schemes, see from_generator().
+    _generators = ("gradient", "rainbow", "palette", "random")
+    # Generated colors by topic, cached by (generator, room name).
+    _generated = {}
+    # C4Room subclasses by light topic.
+    _rooms = {}
 
     def __init__(self, init=""):
         self.mapping = {}
         self.single_color = False
         self.return_random_color = False
+        self.generator = None # (name, arguments) tuple, see from_generator().
         self.available = None # List of available presets.
+        self.library = None # PresetLibrary, see _get_library().
         if init:
             # Load or generate preset.
-            if init[0] == '#':
+            if init[0] == '#' or init[:4] in ("rgb(", "hsv("):
                 return self.from_color(init)
+            elif init.partition('(')[0].strip() in self._generators \
+                    and init.rstrip()[-1:] == ')':
+                return self.from_generator(init)
             elif self._expand_preset(init) == "off":
                 # Virtual preset: set all to #000000.
                 return self.from_color("000000")
@@ -847,6 +2037,7 @@ class ColorScheme: # {{{1
         if self.mapping: return True
         if self.single_color: return True
         if self.return_random_color: return True
+        if self.generator: return True
         else: return False
 
     def _get_config_dir(self, ignore_missing=False, create=False):
@@ -877,6 +2068,18 @@ class ColorScheme: # {{{1
 
         return config_dir
 
+    def _get_library(self, config_dir, create=False):
+        """ Returns the PresetLibrary in config_dir or None if there is none
+            (and create is not true). """
+
+        import os
+
+        if self.library is None:
+            path = os.path.join(config_dir, PresetLibrary.filename)
+            if create or os.path.exists(path):
+                self.library = PresetLibrary(path)
+        return self.library
+
     def _expand_preset(self, preset):
         """ Tries to expand given string to a valid preset name. """
 
@@ -887,7 +2090,12 @@ class ColorScheme: # {{{1
             if not config_dir:
                 self.available = self._virtual_presets.copy()
             else:
-                self.available = os.listdir(config_dir)
+                self.available = [f for f in os.listdir(config_dir)
+                                  if f not in self._reserved]
+                library = self._get_library(config_dir)
+                if library:
+                    self.available.extend(n for n in library.names()
+                                          if n not in self.available)
                 self.available.extend(self._virtual_presets)
 
         # Search for an exact match first.
@@ -905,18 +2113,16 @@ class ColorScheme: # {{{1
 
         return topic.lower().rfind("/master") == len(topic)-7 # 7 = len("/master")
 
-    def _random_color(self):
-        """ Returns a 3*4 bit pseudo random color in 6 char hex notation. """
+    def _random_color(self, rng=None):
+        """ Returns a 3*4 bit pseudo random color in 6 char hex notation.
 
-        from random import randint, sample
+            rng may be a random.Random instance to use. """
 
-        channels = [15, 0]
-        channels.append(randint(0,15))
+        import random
 
-        color = ""
-        for ch in sample(channels, k=3):
-            color += hex(ch)[2:]*2
-        return color
+        rng = rng or random
+        channels = [0xff, 0x00, rng.randint(0, 15) * 0x11]
+        return bytes(rng.sample(channels, k=3)).hex()
 
     def get_color_for(self, topic):
         """ Returns color for topic.
@@ -935,6 +2141,9 @@ class ColorScheme: # {{{1
             # master topics.
             if not self._topic_is_master(topic):
                 return self._random_color()
+        elif self.generator:
+            if not self._topic_is_master(topic):
+                return self._generate(topic)
         # Fallback.
         return None
 
@@ -952,15 +2161,32 @@ class ColorScheme: # {{{1
 
             # Expand preset name.
             preset = self._expand_preset(preset)
-            # Try to open the preset file.
+            # Try to open the preset file. Fall back to the library.
             fn = os.path.join(config_dir, preset)
+            library = self._get_library(config_dir)
             try:
                 fd = open(fn)
             except OSError:
-                print("Error: could not load preset \"{}\" (file could not be accessed)!".format(preset))
-                return
+                if library and preset in library:
+                    import io
+                    fd = io.StringIO(library.get(preset))
+                else:
+                    print("Error: could not load preset \"{}\" (file could not be accessed)!".format(preset))
+                    return
+
+        self._parse(fd, preset)
+        fd.close()
+
+    def from_text(self, text, preset="-"):
+        """ Load ColorScheme from text in the preset file format. """
+
+        import io
+
+        self._parse(io.StringIO(text), preset)
+
+    def _parse(self, fd, preset):
+        """ Parse the preset file fd. """
 
-        # Parse the preset file.
         self.mapping = {}
         self.name = preset
         for line in fd.readlines():
@@ -975,17 +2201,15 @@ class ColorScheme: # {{{1
             vl = v.rstrip("\n\r").split('#')
             v = vl[0] or vl[1]
 
-            # Validate hex code.
-            for c in v.lower():
-                if c not in "0123456789abcdef":
-                    print("Error: invalid color code \"{}\" in preset \"{}\"!".format(v, preset), file=sys.stderr)
-                    sys.exit(1)
+            # Validate color code.
+            if not Color().is_valid(v):
+                print("Error: invalid color code \"{}\" in preset \"{}\"!".format(v, preset), file=sys.stderr)
+                sys.exit(1)
             self.mapping[k] = v
 
-        fd.close()
-
     def from_color(self, color):
-        """ Derive ColorScheme from a single hex color. """
+        """ Derive ColorScheme from a single color (see Color for valid
+            notations). """
 
         self.single_color = color.lstrip('#')
 
@@ -994,35 +2218,136 @@ class ColorScheme: # {{{1
 
         self.return_random_color = True
 
-    def list_available(self):
-        """ List available presets. """
+    def from_generator(self, notation):
+        """ Derive ColorScheme from a generator computing the colors of all
+            lights of a room in one go. Valid notations are:
+                gradient(COLOR, COLOR[, ...])  blend colors across a room
+                rainbow([START[, SPAN]])       rotate the hue across a room,
+                                               starting at START degrees
+                palette(COLOR[, ...])          assign colors to lights in turn
+                random(SEED)                   reproducible random colors
+            See Color for valid notations of COLOR. Lights are taken in the
+            order they are listed in C4Room.lights. """
+
+        name, sep, args = notation.strip()[:-1].partition('(')
+        name = name.strip()
+
+        # Split args at commas, but not at those within rgb(...).
+        values, depth, start = [], 0, 0
+        for i, c in enumerate(args + ','):
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if c == ',' and depth == 0:
+                values.append(args[start:i].strip())
+                start = i + 1
+        values = [v for v in values if v]
+
+        try:
+            if name in ("gradient", "palette"):
+                if len(values) < (2 if name == "gradient" else 1):
+                    raise ValueError("too few colors")
+                for v in values:
+                    if not Color().is_valid(v):
+                        raise ValueError("invalid color \"{}\"".format(v))
+            elif name == "rainbow":
+                if len(values) > 2: raise ValueError("too many values")
+                values = [float(v) for v in values]
+            elif len(values) != 1:
+                raise ValueError("expected a seed")
+        except ValueError as error:
+            print("Error: {} in \"{}\"!".format(error, notation), file=sys.stderr)
+            sys.exit(1)
+
+        self.name = notation
+        self.generator = (name, tuple(values))
+
+    def _generate(self, topic):
+        """ Returns the generated color of topic. All colors of a room are
+            generated at once and cached. """
+
+        if not ColorScheme._rooms:
+            for room in C4Room.__subclasses__():
+                for light in room.lights:
+                    ColorScheme._rooms[light.topic] = room
+        room = self._rooms.get(topic)
+        if room is None: return None
+
+        key = (self.generator, room.name)
+        if key in self._generated:
+            return self._generated[key].get(topic)
+
+        name, values = self.generator
+        topics = [l.topic for l in room.lights if not self._topic_is_master(l.topic)]
+        count = len(topics)
+        if name == "gradient":
+            stops = [Color().payload(v)[:3] for v in values]
+            colors = []
+            for i in range(count):
+                # Position between the stops, from 0 to len(stops) - 1.
+                position = i * (len(stops) - 1) / max(count - 1, 1)
+                k = min(int(position), len(stops) - 2)
+                f = position - k
+                colors.append(bytes(round(a + (b - a) * f)
+                              for a, b in zip(stops[k], stops[k + 1])).hex())
+        elif name == "rainbow":
+            from colorsys import hsv_to_rgb
+            start, span = (list(values) + [0, 360][len(values):])[:2]
+            colors = [bytes(round(c * 255) for c in hsv_to_rgb(
+                          (start + span * i / count) / 360 % 1, 1, 1)).hex()
+                      for i in range(count)]
+        elif name == "palette":
+            colors = [values[i % len(values)] for i in range(count)]
+        else:
+            from random import Random
+            # Seed with the room name as well, so rooms look different.
+            rng = Random("{}/{}".format(values[0], room.name))
+            colors = [self._random_color(rng) for i in range(count)]
+
+        self._generated[key] = dict(zip(topics, colors))
+        return self._generated[key].get(topic)
+
+    def available_presets(self, ignore_missing=False):
+        """ Returns a sorted list of the names of available presets. """
 
         import os
 
-        config_dir = self._get_config_dir()
+        config_dir = self._get_config_dir(ignore_missing)
         if not config_dir:
             self.available = self._virtual_presets.copy()
 
         if not self.available:
             self.available = os.listdir(config_dir)
+            library = self._get_library(config_dir)
+            if library:
+                self.available.extend(n for n in library.names()
+                                      if n not in self.available)
             self.available.extend(self._virtual_presets)
         self.available.sort()
+        return [entry for entry in self.available
+                if entry[0] != '.' and entry[-1:] != '~'
+                and entry not in self._reserved]
+
+    def list_available(self):
+        """ List available presets. """
+
         print("Available presets:\n")
-        for entry in self.available:
-            if entry[0] == '.' or entry[-1:] == '~': continue
+        for entry in self.available_presets():
             print("  " + entry)
 
-    def store(self, name):
-        """ Store the current state of all lights as preset. """
+    def store(self, name, colorscheme=None):
+        """ Store the current state of all lights as preset.
+
+            If colorscheme is given, store the colors it would apply instead,
+            eg. to freeze generated or random colors. """
 
         # Refuse to save under a name used by virtual presets. Let's also
-        # refuse to save as "config" or "c4ctrl.conf", as we may use one these
-        # file names in the future.
-        if name in self._virtual_presets or name in ["config", "c4ctrl.conf"]:
+        # refuse to save as "config" or "c4ctrl.conf", as we use these file
+        # names for configuration.
+        if name in self._virtual_presets or name in self._reserved:
             print("I'm sorry Dave. I'm afraid I can't do that. The name \"{}\" \
 is reserved. Please choose a different one.".format(name))
             return False
 
+        library = None
         if name == '-':
             fd = sys.stdout
         else:
@@ -1033,21 +2358,48 @@ is reserved. Please choose a different one.".format(name))
             # Strip any path elements.
             name = os.path.split(name)[1]
             fn = os.path.join(config_dir, name)
+            # Use the preset library if there is one, unless there is a
+            # preset file of this name already.
+            if not os.path.exists(fn):
+                library = self._get_library(config_dir)
+
+            exists = False
+            if library is not None:
+                import io
+                exists = name in library
+                fd = io.StringIO() # Added to the library when complete.
+            else:
+                try:
+                    fd = open(fn, 'xt') # x = new file (writing), t = text mode.
+                except FileExistsError:
+                    exists = True
 
-            try:
-                fd = open(fn, 'xt') # x = new file (writing), t = text mode.
-            except FileExistsError:
+            if exists:
                 print("A preset with this name already exists, overwrite? [y/N]",
                         end=' ', flush=True)
-                if sys.stdin.read(1).lower() == 'y':
-                    fd = open(fn, 'wt')
-                else:
+                if sys.stdin.read(1).lower() != 'y':
                     return False
+                if library is None:
+                    fd = open(fn, 'wt')
+
+        self.write(fd, None if name == '-' else name, colorscheme)
+
+        # Close opened files, but not stdout.
+        if library is not None:
+            library.add(name, fd.getvalue())
+            print("Added preset \"{}\" to library".format(name))
+        elif name != '-':
+            fd.close()
+            print("Wrote preset \"{}\"".format(name))
+
+    def write(self, fd, name=None, colorscheme=None):
+        """ Write the current state of all lights (or the colors colorscheme
+            would apply) to fd in the preset file format. """
 
-        # Get current states.
+        # Get current states (if needed).
         c4 = C4Interface()
 
-        if name == '-':
+        if name is None:
             fd.write("# c4ctrl preset (auto generated)\n".format(name))
         else:
             fd.write("# c4ctrl preset \"{}\" (auto generated)\n".format(name))
@@ -1063,27 +2415,276 @@ is reserved. Please choose a different one.".format(name))
                 if len(light.topic) > max_topic_len:
                     max_topic_len = len(light.topic)
 
-            responce = c4.pull(topics)
+            if colorscheme is None:
+                responce = c4.pull(topics)
+                colors = dict((r.topic, r.payload.hex()) for r in responce)
+            else:
+                colors = dict((t, colorscheme.get_color_for(t)) for t in topics)
             fd.write("\n# {}\n".format(room.name))
             for light in room.lights:
-                for r in responce:
-                    if r.topic == light.topic:
-                        light.set_color(r.payload.hex())
-                        # Format payload more nicely.
-                        color = light.color
-                        if len(color) > 6:
-                            color = color[:6] + ' ' + color[6:]
-                        topic = light.topic.ljust(max_topic_len)
-                        # Out comment master, as it would override everything else.
-                        if self._topic_is_master(r.topic):
-                            fd.write("#{} = {}\n".format(topic, color))
-                        else:
-                            fd.write("{} = {}\n".format(topic, color))
+                if colors.get(light.topic):
+                    color = light.payload(colors[light.topic]).hex()
+                    # Format payload more nicely.
+                    if len(color) > 6:
+                        color = color[:6] + ' ' + color[6:]
+                    topic = light.topic.ljust(max_topic_len)
+                    # Out comment master, as it would override everything else.
+                    if self._topic_is_master(light.topic):
+                        fd.write("#{} = {}\n".format(topic, color))
+                    else:
+                        fd.write("{} = {}\n".format(topic, color))
+# }}}1
 
-        # Close opened files, but not stdout.
-        if name != '-':
-            fd.close()
-            print("Wrote preset \"{}\"".format(name))
+class PresetLibrary: # {{{1
+    """ Many presets in a single, indexed file.
+
+        Presets are stored in the same text format as preset files. The
+        file is memory mapped, looking up a preset reads its bytes only.
+            bytes   _MAGIC
+            uint64  offset of the index
+            bytes   presets (utf-8), one after another
+            uint32  number of index entries, followed by the entries:
+                uint16  length of name
+                bytes   name (utf-8)
+                uint64  offset of preset
+                uint32  length of preset
+        Adding a preset appends it along with a new index. Replaced presets
+        and old indexes stay in the file until it is compacted. """
+
+    _MAGIC = b"C4LIB\x01"
+    _HEADER = "<Q" # Offset of the index.
+    _ENTRY = "<QI" # Offset and length of a preset.
+    # Name of the library in the config directory.
+    filename = "presets.c4lib"
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {} # (offset, length) of presets by name.
+        self._map = None
+        self.load()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        """ Returns the names of all presets in the library. """
+
+        return list(self.index)
+
+    def load(self):
+        """ (Re-)open the library and read its index. """
+
+        import mmap, os, struct
+
+        self.close()
+        self.index = {}
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+
+        with open(self.path, "rb") as fd:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        m = self._map
+        if m[:len(self._MAGIC)] != self._MAGIC:
+            print("Error: \"{}\" is not a c4ctrl preset library!".format(
+                self.path), file=sys.stderr)
+            sys.exit(1)
+
+        pos = struct.unpack_from(self._HEADER, m, len(self._MAGIC))[0]
+        count = struct.unpack_from("<I", m, pos)[0]
+        pos += 4
+        for unused in range(count):
+            length = struct.unpack_from("<H", m, pos)[0]
+            name = m[pos + 2:pos + 2 + length].decode()
+            pos += 2 + length
+            self.index[name] = struct.unpack_from(self._ENTRY, m, pos)
+            pos += struct.calcsize(self._ENTRY)
+
+    def close(self):
+        """ Unmap the library file. """
+
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def get(self, name):
+        """ Returns the preset name as text. """
+
+        offset, length = self.index[name]
+        return self._map[offset:offset + length].decode()
+
+    def _pack_index(self):
+        import struct
+
+        index = [struct.pack("<I", len(self.index))]
+        for name, entry in self.index.items():
+            name = name.encode()
+            index.append(struct.pack("<H", len(name)) + name
+                         + struct.pack(self._ENTRY, *entry))
+        return b"".join(index)
+
+    def add(self, name, text):
+        """ Add preset name (replacing an existing one) to the library. """
+
+        self.update({name: text})
+
+    def update(self, presets):
+        """ Add presets, a dict of texts by name, to the library. """
+
+        import os, struct
+
+        mode = "r+b" if os.path.exists(self.path) else "w+b"
+        with open(self.path, mode) as fd:
+            fd.seek(0, os.SEEK_END)
+            if fd.tell() == 0:
+                fd.write(self._MAGIC + struct.pack(self._HEADER, 0))
+            for name, text in presets.items():
+                data = text.encode()
+                self.index[name] = (fd.tell(), len(data))
+                fd.write(data)
+
+            # Write the new index first. Until the header points to it, the
+            # old one stays valid.
+            index = fd.tell()
+            fd.write(self._pack_index())
+            fd.flush()
+            os.fsync(fd.fileno())
+            fd.seek(len(self._MAGIC))
+            fd.write(struct.pack(self._HEADER, index))
+        self.load()
+
+    def compact(self):
+        """ Rewrite the library, dropping replaced presets and old indexes. """
+
+        import os
+
+        presets = dict((name, self.get(name)) for name in self.names())
+        tmp = self.path + ".tmp"
+        if os.path.exists(tmp): os.remove(tmp)
+        library = PresetLibrary(tmp)
+        library.update(presets)
+        library.close()
+        os.replace(tmp, self.path)
+        self.load()
+
+    def import_files(self, config_dir, names=None):
+        """ Copy preset files from config_dir into the library. Returns the
+            number of presets imported. """
+
+        import os
+
+        presets = {}
+        for name in names or os.listdir(config_dir):
+            fn = os.path.join(config_dir, name)
+            if name[0] == '.' or name[-1:] == '~' or not os.path.isfile(fn):
+                continue
+            if name in ColorScheme._reserved: continue
+            with open(fn) as fd:
+                presets[name] = fd.read()
+        if presets:
+            self.update(presets)
+            self.compact()
+        return len(presets)
+
+    def export_files(self, directory, overwrite=False):
+        """ Write every preset of the library to a file in directory.
+            Returns the number of presets written. """
+
+        import os
+
+        count = 0
+        for name in self.names():
+            fn = os.path.join(directory, name)
+            if os.path.exists(fn) and not overwrite:
+                print("Skipping \"{}\", file exists.".format(name), file=sys.stderr)
+                continue
+            with open(fn, "wt") as fd:
+                fd.write(self.get(name))
+            count += 1
+        return count
+# }}}1
+
+def plan_transition(scheme, rooms=None, minimal=False, current=None): # {{{1
+    """ Returns a list of (room, messages) tuples needed to apply
+        ColorScheme(s) to multiple rooms.
+
+        scheme and rooms are the same as for apply_scheme(). If minimal is
+        true, lights which already show their target color are left out.
+        current is the ColorScheme the lights are assumed to show; the state
+        of all lights is queried from the broker (in a single request) if
+        current is omitted. """
+
+    if isinstance(scheme, ColorScheme):
+        if rooms is None: rooms = (Wohnzimmer, Plenarsaal, Fnordcenter)
+        scheme = [(room, scheme) for room in rooms]
+    scheme = [(room() if isinstance(room, type) else room, colorscheme)
+              for room, colorscheme in scheme]
+
+    plan = [(room, room.colorscheme_commands(colorscheme))
+            for room, colorscheme in scheme]
+    if not minimal: return plan
+
+    # Get the current payload of every light.
+    state = {}
+    if current is None:
+        topics = [light.topic for room, colorscheme in scheme
+                  for light in room.lights]
+        responce = C4Interface().pull(topics) or []
+        if type(responce) != list: responce = [responce]
+        for r in responce:
+            state[r.topic] = bytes(r.payload)
+    else:
+        for room, colorscheme in scheme:
+            for light in room.lights:
+                color = current.get_color_for(light.topic)
+                if color:
+                    state[light.topic] = light.payload(color)
+
+    for i, (room, command) in enumerate(plan):
+        master = room.master and room.master.topic
+        if command and command[0]["topic"] == master:
+            # Keep the master (changing all lights at once) unless every
+            # other light already shows its color.
+            lights = [c for c in command[1:]
+                      if state.get(c["topic"]) != bytes(c["payload"])]
+            command = command[:1] + lights if lights else []
+        else:
+            command = [c for c in command
+                       if state.get(c["topic"]) != bytes(c["payload"])]
+        plan[i] = (room, command)
+    return plan
+# }}}1
+
+def apply_scheme(scheme, rooms=None, minimal=False, current=None, stagger=0): # {{{1
+    """ Apply ColorScheme(s) to multiple rooms at once.
+
+        scheme may be a ColorScheme, which is then applied to every room in
+        rooms, or a list of (room, ColorScheme) tuples. rooms is a list of
+        C4Room classes or instances and defaults to every room with DMX
+        lights. Colors of all rooms are resolved in one pass and published
+        as a single batch. See plan_transition() for minimal and current.
+
+        If stagger is given, rooms are changed one after another, waiting
+        stagger seconds in between, to spread the load on the broker. """
+
+    plan = [(room, command) for room, command
+            in plan_transition(scheme, rooms, minimal, current) if command]
+
+    # Nothing to do. May happen if a preset defines no color for any room or
+    # every light already shows the right color.
+    if plan == []: return
+
+    c4 = C4Interface()
+    if not stagger:
+        return c4.push([c for room, command in plan for c in command])
+
+    from time import sleep
+
+    for i, (room, command) in enumerate(plan):
+        if i: sleep(stagger)
+        c4.push(command)
 # }}}1
 
 class RemotePresets: # {{{1
@@ -1199,13 +2800,14 @@ class RemotePresets: # {{{1
             req.append(self.map[room]["list_topic"])
 
         c4 = C4Interface()
-        responce = c4.pull(req)
+        responce = c4.pull(req) or []
         # Make responce iterable.
         if type(responce) != list: responce = [responce]
 
         available = {}
         for room in rooms:
             for r in responce:
+                if r is None: continue # Timed out.
                 if r.topic == self.map[room]["list_topic"]:
                     available[room] = json.decoder.JSONDecoder().decode(r.payload.decode())
 
@@ -1272,87 +2874,2623 @@ class RemotePresets: # {{{1
         return c4.push(name, topic=self.map[domain]["def_topic"])
 # }}}1
 
-if __name__ == "__main__": # {{{1
-    import argparse
+class Dashboard: # {{{1
+    """ Live view of the state of the club in a terminal.
+
+        Subscribes once to club status, Kitchenlight, light switches and DMX
+        topics and redraws only what changed whenever a message arrives. """
+
+    def __init__(self, rooms=None):
+        self.rooms = rooms or (Wohnzimmer, Plenarsaal, Fnordcenter, Keller)
+        self.kl = Kitchenlight()
+        # Cells by topic. A cell is a tuple (row, column, render) with render
+        # being a function returning the text to display for a payload.
+        self.cells = {}
+        self.lines = [] # Static text of the dashboard.
+        self.state = {} # Last payload by topic.
+        self._layout()
+
+    def _add_line(self, text=""):
+        self.lines.append(text)
+        return len(self.lines) # Terminal rows start at 1.
+
+    def _layout(self):
+        """ Arrange all cells on the screen. """
+
+        row = self._add_line("Club:")
+        self.cells["club/status"] = (row, 7, self._render_status)
+        row = self._add_line("Kitchenlight:")
+        self.cells[self.kl.powertopic] = (row, 15, self._render_power)
+        self.cells[self.kl.topic] = (row, 20, self._render_kitchenlight)
+
+        for room in self.rooms:
+            self._add_line()
+            self._add_line("[{}]".format(room.name))
+
+            # Light switches.
+            line, cells = "", []
+            for label, topic in room.switches:
+                cells.append((topic, len(line) + len(label) + 3))
+                line += "{} [ ]  ".format(label)
+            row = self._add_line(line)
+            for topic, column in cells:
+                self.cells[topic] = (row, column, self._render_switch)
+
+            # DMX lights, several in a row.
+            line = ""
+            for light in room.lights:
+                name = light.topic.split('/')[-1]
+                if len(line) + len(name) + 5 > 78:
+                    row = self._add_line(line)
+                    line = ""
+                self.cells[light.topic] = (len(self.lines) + 1,
+                                           len(line) + len(name) + 2,
+                                           self._render_dmx)
+                line += "{}     ".format(name)
+            if line: self._add_line(line)
 
-    parser = argparse.ArgumentParser(
-        description="Command line client for AutoC4.")
-    parser.add_argument(
-        "-d", "--debug", action="store_true",
-        help="display what would be send to the MQTT broker, but do not \
-        actually connect")
+    def _render_status(self, payload):
+        return "open  " if payload == b'\x01' else "closed"
 
-    # Various club functions
-    group_fn = parser.add_argument_group(title="various functions")
-    group_fn.add_argument(
-        "-s", "--status", action="store_true",
-        help="display club status")
-    group_fn.add_argument(
-        "-g", "--gate", action="store_true",
-        help="open club gate")
-    group_fn.add_argument(
-        "-S", "--shutdown", action="count",
-        help="shutdown (give twice to force shutdown)")
-    group_fn.add_argument(
-        "--cyberalert", nargs=1, type=int, metavar="0|1",
-        help="start/stop cyberalert")
+    def _render_power(self, payload):
+        return "on " if payload == b'\x01' else "off"
 
-    # Kitchenlight control
-    group_kl = parser.add_argument_group(title="Kitchenlight control")
-    group_kl.add_argument(
-        "-k", "--kl-mode", nargs='+', type=str, metavar=("MODE", "OPTIONS"),
-        help="set Kitchenlight to MODE (MODE may be abbreviated)")
-    group_kl.add_argument(
-        "-i", "--list-kl-modes", action="store_true",
-        help="list available Kitchenlight modes and their options")
+    def _render_kitchenlight(self, payload):
+        return self.kl.describe(payload)[:58].ljust(58)
 
-    # Ambient control
-    group_cl = parser.add_argument_group(title="ambient color control",
-        description="PRESET may be either a preset name (which may be \
-        abbreviated), '#' followed by a color value in hex notation (e.g. \
-        \"#ff0066\") or '-' to read from stdin.")
-    group_cl.add_argument(
-        "-w", "--wohnzimmer", type=str, dest="w_color", metavar="PRESET",
-        help="apply local colorscheme PRESET to Wohnzimmer")
-    group_cl.add_argument(
-        "-p", "--plenarsaal", type=str, dest="p_color", metavar="PRESET",
-        help="apply local colorscheme PRESET to Plenarsaal")
-    group_cl.add_argument(
-        "-f", "--fnordcenter", type=str, dest="f_color", metavar="PRESET",
-        help="apply local colorscheme PRESET to Fnordcenter")
-    group_cl.add_argument(
-        "-l", "--list-presets", action="store_true",
-        help="list locally available presets")
-    group_cl.add_argument(
-        "-o", "--store-preset", type=str, dest="store_as", metavar="NAME",
-        help="store current state as preset NAME ('-' to write to stdout)")
+    def _render_switch(self, payload):
+        return "x" if payload == b'\x01' else " "
 
-    # Switch control
-    group_sw = parser.add_argument_group(title="light switch control",
-        description="BINARY_CODE is a string of 0s or 1s for every light in a \
-        room. May be given as decimal. May be prepended by '~', '&', '|' or \
-        '^' as NOT, AND, OR and XOR operators. Current switch states will be \
-        printed to stdout if BINARY_CODE is '-'. Will show usage information \
-        and ask for input if BINARY_CODE is omitted. Will read from stdin if \
-        BINARY_CODE \ is omitted and stdin is not connected to a TTY.")
-    group_sw.add_argument(
-        "-W", nargs='?', dest="w_switch", const="", metavar="BINARY_CODE",
-        help="switch lights and sockets in Wohnzimmer on/off")
-    group_sw.add_argument(
-        "-P", nargs='?', dest="p_switch", const="", metavar="BINARY_CODE",
-        help="switch lights in Plenarsaal on/off")
-    group_sw.add_argument(
-        "-F", nargs='?', dest="f_switch", const="", metavar="BINARY_CODE",
-        help="switch lights in Fnordcentter on/off")
-    group_sw.add_argument(
-        "-K", nargs='?', dest="k_switch", const="", metavar="BINARY_CODE",
-        help="switch lights in Keller on/off")
+    def _render_dmx(self, payload):
+        """ Returns a color swatch for a DMX payload. """
 
-    # Remote presets
-    group_rp = parser.add_argument_group(title="remote preset functions",
-        description="Available room names are \"wohnzimmer\", \"plenar\", \
-        \"fnord\" and \"keller\". Preset and room names may be abbreviated.")
-    group_rp.add_argument(
+        if len(payload) < 3: return "??"
+        red, green, blue = payload[0:3]
+        if len(payload) in (4, 7):
+            # The last byte of 4 and 7 channel cans is the brightness.
+            red, green, blue = (c * payload[-1] // 255 for c in (red, green, blue))
+        return "\033[48;2;{};{};{}m  \033[0m".format(red, green, blue)
+
+    def _draw(self, topic, payload):
+        """ Redraw the cell of topic. """
+
+        row, column, render = self.cells[topic]
+        sys.stdout.write("\033[{};{}H{}".format(row, column, render(payload)))
+
+    def run(self):
+        """ Display the dashboard until interrupted. """
+
+        from queue import Queue
+
+        updates = Queue()
+        c4 = C4Interface()
+        c4.subscribe(list(self.cells), lambda m: updates.put((m.topic, m.payload)))
+        if C4Interface.debug: return
+
+        tty = sys.stdout.isatty()
+        if tty:
+            # Clear the screen, hide the cursor and draw the static parts.
+            sys.stdout.write("\033[?25l\033[H\033[2J" + "\n".join(self.lines))
+            sys.stdout.flush()
+
+        try:
+            while True:
+                # Block until a message arrives, there is nothing to do
+                # otherwise.
+                topic, payload = updates.get()
+                if self.state.get(topic) == payload: continue
+                self.state[topic] = payload
+
+                if tty:
+                    self._draw(topic, payload)
+                    # Park the cursor below the dashboard.
+                    sys.stdout.write("\033[{};1H".format(len(self.lines) + 1))
+                else:
+                    print(topic, payload.hex())
+                sys.stdout.flush()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            c4.disconnect()
+            if tty:
+                sys.stdout.write("\033[?25h\033[{};1H\n".format(len(self.lines) + 1))
+                sys.stdout.flush()
+# }}}1
+
+class Action: # {{{1
+    """ A single c4ctrl command given as a line of text.
+
+        Valid actions are:
+            preset ROOM PRESET          apply local PRESET to ROOM
+            switch ROOM BINARY_CODE     switch lights in ROOM on/off
+            kitchenlight MODE [OPTIONS] set Kitchenlight to MODE
+            remote PRESET [ROOM ...]    activate remote PRESET for ROOM(s)
+        Room and mode names may be abbreviated. """
+
+    verbs = ("preset", "switch", "kitchenlight", "remote")
+
+    def __init__(self, line):
+        import shlex
+
+        self.line = line.strip()
+        words = shlex.split(self.line)
+        if not words:
+            raise ValueError("empty action")
+
+        self.verb = self._expand(words[0], self.verbs)
+        self.args = words[1:]
+        if self.verb not in self.verbs:
+            raise ValueError("unknown action \"{}\"".format(words[0]))
+
+        if self.verb in ("preset", "switch"):
+            if len(self.args) != 2:
+                raise ValueError("\"{}\" takes a room and one argument".format(
+                    self.verb))
+            self.room = self._expand_room(self.args[0])
+        elif not self.args:
+            raise ValueError("\"{}\" needs an argument".format(self.verb))
+
+    def __repr__(self):
+        return "Action({!r})".format(self.line)
+
+    @staticmethod
+    def _expand(name, candidates):
+        """ Returns the first of candidates beginning with name. """
+
+        for candidate in candidates:
+            if candidate.find(name.lower()) == 0:
+                return candidate
+        return name
+
+    @classmethod
+    def _expand_room(cls, name):
+        """ Returns the C4Room subclass named (or abbreviated) name. """
+
+        rooms = dict((room.name.lower(), room) for room in C4Room.__subclasses__())
+        room = cls._expand(name, rooms.keys())
+        if room not in rooms:
+            raise ValueError("unknown room \"{}\"".format(name))
+        return rooms[room]
+
+    def run(self):
+        """ Execute this action. """
+
+        if self.verb == "preset":
+            return self.room().set_colorscheme(ColorScheme(self.args[1]))
+        if self.verb == "switch":
+            return self.room().light_switch(self.args[1])
+        if self.verb == "kitchenlight":
+            return Kitchenlight().set_mode(self.args[0], self.args[1:])
+        if self.verb == "remote":
+            return RemotePresets().apply_preset(self.args[0],
+                                                self.args[1:] or ["global"])
+# }}}1
+
+class Rule: # {{{1
+    """ A trigger -> action rule evaluated by the RulesEngine. """
+
+    def __init__(self, name, topic, actions, payload=None, debounce=0,
+                 between=None):
+        """ name = name of the rule
+            topic = topic to watch (may contain wildcards)
+            actions = list of Actions to run when triggered
+            payload = condition: payload in hex, "text" in quotes, both
+                      optionally prepended by '!=' (default: any payload)
+            debounce = seconds the condition must hold before triggering
+            between = time window like "18:00-06:00" (default: any time) """
+
+        self.name = name
+        self.topic = topic
+        self.actions = actions
+        self.debounce = float(debounce)
+        self.wildcard = '+' in topic or '#' in topic
+
+        # Parse the payload condition into (negate, bytes).
+        self.condition = None
+        if payload:
+            payload = payload.strip()
+            negate = payload[:2] == "!="
+            payload = payload.lstrip("!=").strip()
+            if payload[:1] == '"' and payload[-1:] == '"':
+                payload = payload[1:-1].encode()
+            else:
+                payload = bytes.fromhex(payload)
+            self.condition = (negate, payload)
+
+        # Parse the time window into minutes since midnight.
+        self.window = None
+        if between:
+            start, end = between.split('-')
+            self.window = tuple(int(t.split(':')[0]) * 60 + int(t.split(':')[1])
+                                for t in (start, end))
+
+    def matches(self, payload):
+        """ Does payload fulfill the condition of this rule? """
+
+        if self.condition is None: return True
+        negate, value = self.condition
+        return (bytes(payload) == value) != negate
+
+    def in_window(self):
+        """ Is the current local time within the time window of this rule? """
+
+        from time import localtime
+
+        if self.window is None: return True
+        now = localtime()
+        now = now.tm_hour * 60 + now.tm_min
+        start, end = self.window
+        if start <= end:
+            return start <= now < end
+        return now >= start or now < end # Window spans midnight.
+# }}}1
+
+class RulesEngine: # {{{1
+    """ Evaluate rules on every message received from the broker and run
+        their actions.
+
+        Rules are read from a file like this (one section per rule):
+            [lights off when closed]
+            topic = club/status
+            payload = 00
+            debounce = 60
+            between = 18:00-10:00
+            action = switch wohnzimmer 0
+                     switch plenar 0
+                     kitchenlight off
+
+        See Rule and Action for the available options. """
+
+    def __init__(self, filename=None):
+        from queue import Queue
+
+        self.rules = []
+        self.index = {} # Rules by topic, for topics without wildcards.
+        self.wildcard = [] # Rules with wildcards in their topic.
+        self._pending = {} # Debounce timers by rule.
+        self._queue = Queue() # Messages and expired debounce timers.
+        if filename:
+            self.load(filename)
+
+    def load(self, filename):
+        """ Load rules from filename. Returns False on errors. """
+
+        import configparser
+
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            if not parser.read(filename):
+                print("Error: could not read rules file \"{}\"!".format(filename),
+                      file=sys.stderr)
+                return False
+        except configparser.Error as error:
+            print("Error: {}".format(error), file=sys.stderr)
+            return False
+
+        for name in parser.sections():
+            section = parser[name]
+            try:
+                actions = [Action(line) for line
+                           in section.get("action", "").splitlines() if line.strip()]
+                if not actions:
+                    raise ValueError("no action given")
+                self.add(Rule(name, section["topic"], actions,
+                              payload=section.get("payload"),
+                              debounce=section.get("debounce", 0),
+                              between=section.get("between")))
+            except (KeyError, ValueError) as error:
+                print("Error in rule \"{}\": {}".format(name, error), file=sys.stderr)
+                return False
+        return True
+
+    def add(self, rule):
+        """ Add rule and update the topic index. """
+
+        self.rules.append(rule)
+        if rule.wildcard:
+            self.wildcard.append(rule)
+        else:
+            self.index.setdefault(rule.topic, []).append(rule)
+
+    def _affected(self, topic):
+        """ Returns the rules watching topic. """
+
+        rules = self.index.get(topic, [])
+        if self.wildcard:
+            from paho.mqtt.client import topic_matches_sub
+            rules = rules + [r for r in self.wildcard
+                             if topic_matches_sub(r.topic, topic)]
+        return rules
+
+    def handle(self, topic, payload, retain=False):
+        """ Evaluate the rules affected by a message.
+
+            Returns the rules which are due to run right now. Rules with a
+            debounce time are put on hold and reported via the queue given
+            to run() once their condition held long enough. Retained
+            messages describe the state before we connected and never
+            trigger anything. """
+
+        due = []
+        for rule in self._affected(topic):
+            if not rule.matches(payload):
+                # Condition does not hold (anymore), cancel pending triggers.
+                timer = self._pending.pop(rule, None)
+                if timer: timer.cancel()
+                continue
+
+            if retain: continue
+
+            if rule.debounce:
+                if rule not in self._pending:
+                    from threading import Timer
+                    timer = Timer(rule.debounce, self._expire)
+                    # The timer identifies this very trigger, see execute().
+                    timer.args = (rule, timer)
+                    timer.daemon = True
+                    self._pending[rule] = timer
+                    timer.start()
+            elif rule.in_window():
+                due.append(rule)
+        return due
+
+    def _expire(self, rule, timer):
+        """ Called when the debounce time of rule is over. """
+
+        self._queue.put(("rule", (rule, timer)))
+
+    def execute(self, rule, verbose=False, timer=None):
+        """ Run the actions of rule.
+
+            Debounced rules are only run if timer is still pending for them,
+            ie. the condition has held since timer was started. """
+
+        if timer is not None:
+            if self._pending.get(rule) is not timer: return
+            del self._pending[rule]
+        if not rule.in_window(): return
+
+        verbose and print("Rule \"{}\" triggered.".format(rule.name), file=sys.stderr)
+        for action in rule.actions:
+            try:
+                action.run()
+            except SystemExit:
+                # Some commands exit on errors. Let's not stop the engine.
+                print("Error: action \"{}\" of rule \"{}\" failed!".format(
+                    action.line, rule.name), file=sys.stderr)
+            except Exception as error:
+                # Nor on a bad color or an unreachable broker.
+                print("Error: action \"{}\" of rule \"{}\" failed: {}".format(
+                    action.line, rule.name, error), file=sys.stderr)
+
+    def run(self, verbose=False):
+        """ Subscribe to all topics used by rules and evaluate them until
+            interrupted. """
+
+        c4 = C4Interface()
+        c4.subscribe(list(set(r.topic for r in self.rules)),
+            lambda m: self._queue.put(("message", m)))
+        if C4Interface.debug: return
+
+        # Rules are evaluated and run in this thread only, as actions may
+        # need to wait for messages handled by the network thread.
+        try:
+            while True:
+                kind, item = self._queue.get()
+                if kind == "message":
+                    for rule in self.handle(item.topic, item.payload, item.retain):
+                        self.execute(rule, verbose)
+                else:
+                    self.execute(item[0], verbose, timer=item[1])
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            c4.disconnect()
+# }}}1
+
+class SceneLog: # {{{1
+    """ Record broker traffic into a log file and replay it later on.
+
+        The log is an append-only binary file starting with _MAGIC, followed
+        by one record per message. Every record starts with its length (not
+        including the length field itself) and looks like this:
+            uint32  length
+            float64 seconds since the start of the recording (monotonic)
+            uint8   flags (bit 0: message was retained)
+            uint16  length of topic
+            bytes   topic (utf-8)
+            bytes   payload (the rest of the record) """
+
+    _MAGIC = b"C4LOG\x01"
+    _RECORD = "<IdBH" # Length, timestamp, flags, topic length.
+
+    # Topics which will never be replayed, as they trigger actions instead of
+    # changing a state.
+    _unsafe = ("club/gate", "club/shutdown", "club/cyber/alert")
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def messages(self):
+        """ Iterate over the log, yielding (timestamp, topic, payload,
+            retain) tuples. The file is memory mapped, not read. """
+
+        import mmap, struct
+
+        head = struct.calcsize(self._RECORD)
+        with open(self.filename, "rb") as fd:
+            try:
+                m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty file.
+                return
+
+            with m:
+                if m[:len(self._MAGIC)] != self._MAGIC:
+                    print("Error: \"{}\" is not a c4ctrl log file!".format(
+                        self.filename), file=sys.stderr)
+                    return
+
+                pos = len(self._MAGIC)
+                while pos + head <= len(m):
+                    length, timestamp, flags, topic_len = struct.unpack_from(
+                            self._RECORD, m, pos)
+                    end = pos + 4 + length
+                    if end > len(m): break # Truncated record.
+                    topic = m[pos + head:pos + head + topic_len]
+                    yield (timestamp, topic.decode(), m[pos + head + topic_len:end],
+                           bool(flags & 1))
+                    pos = end
+
+    def record(self, topics=["#"], verbose=False):
+        """ Append every message received on topics to the log until
+            interrupted.
+
+            Returns False if the file exists but is not a c4ctrl log. """
+
+        import os, struct
+        from time import monotonic
+        from threading import Event
+
+        if C4Interface.debug:
+            print("[DEBUG] inhibited recording of:", topics, file=sys.stderr)
+            return True
+
+        # Continue the timeline of an existing log, but never append to
+        # anything else.
+        offset = 0.0
+        if os.path.exists(self.filename):
+            with open(self.filename, "rb") as fd:
+                magic = fd.read(len(self._MAGIC))
+            if magic and magic != self._MAGIC:
+                print("Error: \"{}\" is not a c4ctrl log file!".format(
+                    self.filename), file=sys.stderr)
+                return False
+            for message in self.messages():
+                offset = message[0]
+
+        fd = open(self.filename, "ab")
+        if fd.tell() == 0:
+            fd.write(self._MAGIC)
+        start = monotonic() - offset
+        count = 0
+
+        def write(message):
+            nonlocal count
+            topic = message.topic.encode()
+            head = struct.pack(self._RECORD,
+                    struct.calcsize(self._RECORD) - 4 + len(topic) + len(message.payload),
+                    monotonic() - start, int(message.retain), len(topic))
+            fd.write(head + topic + message.payload)
+            fd.flush()
+            count += 1
+            verbose and print(message.topic, message.payload.hex())
+
+        c4 = C4Interface()
+        c4.subscribe(topics, write)
+        try:
+            Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            c4.disconnect()
+            fd.close()
+            verbose and print("\rRecorded {} messages.".format(count),
+                    file=sys.stderr)
+        return True
+
+    def replay(self, speed=1.0, verbose=False):
+        """ Publish the messages of the log with their original timing.
+
+            speed scales the timing (2 = twice as fast). If speed is 0, all
+            messages are published as fast as possible. """
+
+        from time import monotonic, sleep
+
+        c4 = C4Interface()
+        c4.connect()
+        count = 0
+        start = monotonic()
+        try:
+            for timestamp, topic, payload, retain in self.messages():
+                if topic in self._unsafe: continue
+                if speed:
+                    delay = start + timestamp / speed - monotonic()
+                    if delay > 0: sleep(delay)
+                c4.push(payload, topic=topic, retain=retain)
+                count += 1
+                verbose and print(topic, payload.hex())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            c4.disconnect()
+
+        elapsed = monotonic() - start
+        verbose and print("Replayed {} messages in {:.3f} seconds.".format(
+            count, elapsed), file=sys.stderr)
+        return count
+# }}}1
+
+class History: # {{{1
+    """ Undo changes to lights and switches.
+
+        Before c4ctrl changes the color of a light or a switch, it stores the
+        state of the topics about to change in a snapshot. Snapshots only
+        contain these topics, both before and after the change, and are kept
+        in a ring buffer of the last <size> changes in the runtime directory.
+        undo() restores the state before the last N changes, sending only
+        what differs from the state after the last change. This needs no
+        request to the broker. """
+
+    # Number of snapshots kept.
+    size = 32
+    # Seconds to wait for the state before a change. Lights and switches
+    # which did not answer by then are not restored by undo().
+    timeout = 2
+    # Serializes changes to the history file by threads of this process
+    # (eg. concurrent requests to the Gateway), see _locked().
+    _lock = Lock()
+
+    def __init__(self):
+        import os, tempfile
+
+        if "XDG_RUNTIME_DIR" in os.environ:
+            runtime_dir = os.path.join(os.environ["XDG_RUNTIME_DIR"], "c4ctrl")
+        else:
+            runtime_dir = os.path.join(tempfile.gettempdir(),
+                                       "c4ctrl-{}".format(os.getuid()))
+        self.filename = os.path.join(runtime_dir, "history")
+
+    def _rooms(self):
+        return [Wohnzimmer, Plenarsaal, Fnordcenter, Keller]
+
+    def _topics(self):
+        """ Returns the set of topics snapshots are taken of. """
+
+        topics = set()
+        for room in self._rooms():
+            topics.update(light.topic for light in room.lights)
+            topics.update(switch[1] for switch in room.switches)
+        return topics
+
+    @contextmanager
+    def _locked(self):
+        """ Hold the history file for ourselves, against other threads and
+            (where possible) other c4ctrl processes. """
+
+        import os
+
+        with History._lock:
+            try:
+                import fcntl
+                os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+                fd = open(self.filename + ".lock", "a")
+            except (ImportError, OSError):
+                # Still serialized within this process.
+                yield
+                return
+            with fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+
+    def load(self):
+        """ Returns the list of snapshots, oldest first. """
+
+        import json
+
+        try:
+            with open(self.filename) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as error:
+            print("Warning: could not read history \"{}\": {}".format(
+                self.filename, error), file=sys.stderr)
+            return []
+
+    def save(self, snapshots):
+        """ Write snapshots (atomically), dropping all but the last <size>. """
+
+        import json, os, tempfile
+
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # A temporary file of our own, others may be saving as well.
+        handle, tmp = tempfile.mkstemp(dir=directory, prefix="history.")
+        try:
+            with open(handle, "w") as fd:
+                json.dump(snapshots[-self.size:], fd)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def record(self, messages):
+        """ Take a snapshot of the topics (topic, payload, qos, retain)
+            messages are about to change. """
+
+        from time import time
+
+        watched = self._topics()
+        after = {}
+        for topic, payload, qos, retain in messages:
+            if retain and topic in watched:
+                after[topic] = bytes(payload or b'').hex()
+        if not after: return
+
+        # A master message changes every light of its room, whatever their
+        # topics say.
+        for room in self._rooms():
+            if room.master and room.master.topic in after:
+                for light in room.lights:
+                    after.setdefault(light.topic, after[room.master.topic])
+
+        # Never keep the change itself waiting for (or failing because of)
+        # its snapshot.
+        try:
+            responce = C4Interface().pull(list(after), timeout=self.timeout)
+        except (Exception, SystemExit) as error:
+            print("Warning: no snapshot taken for --undo: {}".format(error),
+                  file=sys.stderr)
+            return
+        if type(responce) != list: responce = [responce]
+        before = dict((r.topic, r.payload.hex()) for r in responce if r)
+
+        changed = [t for t in after if before.get(t) != after[t]]
+        if not changed: return
+
+        with self._locked():
+            snapshots = self.load()
+            snapshots.append({
+                "time" : time(),
+                "before" : dict((t, before.get(t)) for t in changed),
+                "after" : dict((t, after[t]) for t in changed)
+                })
+            try:
+                self.save(snapshots)
+            except OSError as error:
+                print("Warning: could not write history \"{}\": {}".format(
+                    self.filename, error), file=sys.stderr)
+
+    def undo(self, count=1):
+        """ Restore the state before the last count changes. """
+
+        from time import localtime, strftime
+
+        with self._locked():
+            snapshots = self.load()
+        if count < 1 or count > len(snapshots):
+            print("Error: can not undo {} changes, there are {} in \"{}\"!".format(
+                count, len(snapshots), self.filename), file=sys.stderr)
+            return False
+        undone = snapshots[-count:]
+
+        # The state before the oldest and after the newest change.
+        target, current = {}, {}
+        for snapshot in undone:
+            for topic, payload in snapshot["before"].items():
+                target.setdefault(topic, payload)
+            current.update(snapshot["after"])
+
+        masters = [room.master.topic for room in self._rooms() if room.master]
+        command = [(t, bytes.fromhex(p)) for t, p in target.items()
+                   if p is not None and p != current.get(t)]
+        # Master messages would override the lights restored before them.
+        command.sort(key=lambda m: m[0] not in masters)
+
+        print("Undoing {} change{} back to {}".format(count,
+            "s" if count > 1 else "",
+            strftime("%Y-%m-%d %H:%M:%S", localtime(undone[0]["time"]))))
+        c4 = C4Interface()
+        c4.history = False # Don't take a snapshot of the undo itself.
+        c4.push(command)
+        if not C4Interface.debug:
+            # Others may have taken snapshots meanwhile, keep them.
+            done = set(snapshot["time"] for snapshot in undone)
+            with self._locked():
+                self.save([snapshot for snapshot in self.load()
+                           if snapshot["time"] not in done])
+        return True
+# }}}1
+
+class Gateway: # {{{1
+    """ HTTP server giving access to c4ctrl functions via JSON.
+
+        All requests share one persistent connection to the broker. The state
+        of the club is tracked (see C4Interface.track()), so GET requests are
+        answered without asking the broker. Every responce carries an ETag;
+        clients sending it back via If-None-Match get "304 Not Modified" if
+        nothing changed.
+
+            GET  /status                 club status
+            GET  /switches/ROOM          light switches of ROOM
+            POST /switches/ROOM          {"code": "BINARY_CODE"}
+            GET  /colors/ROOM            colors of the LED cans in ROOM
+            POST /colors/ROOM            {"preset": "PRESET"}
+            GET  /kitchenlight           current Kitchenlight mode
+            POST /kitchenlight           {"mode": "MODE", "options": [...]}
+            GET  /presets                local presets
+            GET  /remote-presets[/ROOM]  remote presets for ROOM (or global)
+            POST /remote-presets         {"preset": "PRESET", "rooms": [...]}
+
+        Room, mode and preset names may be abbreviated like on the command
+        line. """
+
+    def __init__(self, host="localhost", port=8080):
+        self.host = host
+        self.port = port
+        self.kl = Kitchenlight()
+        self.remote = RemotePresets()
+
+    def _topics(self):
+        """ Returns the topics needed to answer GET requests. """
+
+        topics = ["club/status", self.kl.topic, self.kl.powertopic]
+        for room in C4Room.__subclasses__():
+            topics.extend(topic for label, topic in room.switches)
+            topics.extend(light.topic for light in room.lights)
+        topics.extend(room["list_topic"] for room in self.remote.map.values())
+        return topics
+
+    def _room(self, path):
+        """ Returns the C4Room subclass given as last element of path. """
+
+        if len(path) != 2:
+            raise LookupError("no room given")
+        try:
+            return Action._expand_room(path[1])
+        except ValueError as error:
+            raise LookupError(str(error))
+
+    def get(self, path):
+        """ Returns the data to answer a GET request for path (a list). """
+
+        c4 = C4Interface()
+        if path == ["status"]:
+            return {"status": c4.status()}
+
+        if path[0] == "switches":
+            room = self._room(path)
+            state = room().get_switch_state(max_age=0)
+            return {
+                "room": room.name,
+                "state": state,
+                "switches": [{"label": label, "topic": topic, "on": on == "1"}
+                             for (label, topic), on in zip(room.switches, state)]
+            }
+
+        if path[0] == "colors":
+            room = self._room(path)
+            # Rooms without lights (Keller) have no colors to pull.
+            responce = c4.pull([light.topic for light in room.lights]) or []
+            if type(responce) != list: responce = [responce]
+            return {
+                "room": room.name,
+                "colors": dict((r.topic, r.payload.hex()) for r in responce if r)
+            }
+
+        if path == ["kitchenlight"]:
+            responce = c4.pull([self.kl.topic, self.kl.powertopic]) or []
+            if type(responce) != list: responce = [responce]
+            payloads = dict((r.topic, r.payload) for r in responce if r)
+            if self.kl.topic not in payloads:
+                raise LookupError("Kitchenlight state unknown")
+            return {
+                "mode": self.kl.describe(payloads[self.kl.topic]),
+                "power": payloads.get(self.kl.powertopic) == b'\x01'
+            }
+
+        if path == ["presets"]:
+            return {"presets": ColorScheme().available_presets(ignore_missing=True)}
+
+        if path[0] == "remote-presets" and len(path) <= 2:
+            room = self.remote._expand_room_name(path[1] if path[1:] else "global")
+            if room not in self.remote.map:
+                raise LookupError("unknown room \"{}\"".format(path[1]))
+            return {"room": room, "presets": self.remote.query_available([room])}
+
+        raise LookupError("not found")
+
+    def post(self, path, data):
+        """ Execute a POST request for path (a list) with the decoded JSON
+            document data. Returns False if the request could not be
+            fulfilled. """
+
+        if path[0] == "switches":
+            code = str(data.get("code", ""))
+            # '-' and empty codes would print or read from stdin.
+            if code in ("", "-"):
+                raise ValueError("invalid switch code")
+            return self._room(path)().light_switch(code)
+
+        if path[0] == "colors":
+            room = self._room(path)
+            preset = str(data.get("preset", ""))
+            # '-' would read from stdin, paths could point anywhere.
+            if preset in ("", "-") or "/" in preset or ".." in preset:
+                raise ValueError("invalid preset")
+            colorscheme = ColorScheme(preset)
+            if not colorscheme:
+                raise ValueError("unknown preset")
+            return room().set_colorscheme(colorscheme)
+
+        if path == ["kitchenlight"]:
+            options = [str(o) for o in data.get("options", [])]
+            return self.kl.set_mode(str(data.get("mode", "")), options)
+
+        if path == ["remote-presets"]:
+            rooms = [str(r) for r in data.get("rooms", [])] or ["global"]
+            return self.remote.apply_preset(str(data.get("preset", "")), rooms)
+
+        raise LookupError("not found")
+
+    def _handler(self, verbose=False):
+        """ Returns a request handler class for http.server. """
+
+        import json
+        from hashlib import sha1
+        from http.server import BaseHTTPRequestHandler
+
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            server_version = "c4ctrl"
+
+            def _reply(self, code, data):
+                body = json.dumps(data, sort_keys=True).encode()
+                etag = '"{}"'.format(sha1(body).hexdigest()[:16])
+                if self.command == "GET" and code == 200 \
+                        and self.headers.get("If-None-Match") == etag:
+                    code, body = 304, b''
+                self.send_response(code)
+                self.send_header("ETag", etag)
+                if body:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method):
+                path = [p for p in self.path.split('?')[0].split('/') if p]
+                try:
+                    if self.command == "POST":
+                        length = int(self.headers.get("Content-Length", 0))
+                        data = json.loads(self.rfile.read(length).decode() or "{}")
+                        if type(data) != dict:
+                            raise ValueError("expected a JSON object")
+                        if method(path or [""], data) is False:
+                            return self._reply(400, {"error": "request failed"})
+                        return self._reply(200, {"ok": True})
+                    self._reply(200, method(path or [""]))
+                except LookupError as error:
+                    self._reply(404, {"error": error.args[0] if error.args else "not found"})
+                except (ValueError, TypeError) as error:
+                    self._reply(400, {"error": str(error)})
+                except SystemExit:
+                    # Some functions exit on errors after printing them.
+                    self._reply(400, {"error": "request failed"})
+                except Exception as error:
+                    self._reply(500, {"error": str(error)})
+
+            def do_GET(self):
+                self._handle(gateway.get)
+
+            def do_POST(self):
+                self._handle(gateway.post)
+
+            def log_message(self, format, *args):
+                if verbose:
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        return Handler
+
+    def run(self, verbose=False):
+        """ Serve requests until interrupted. """
+
+        from http.server import ThreadingHTTPServer
+
+        c4 = C4Interface()
+        c4.track(self._topics())
+        if C4Interface.debug: return
+
+        try:
+            server = ThreadingHTTPServer((self.host, self.port),
+                                         self._handler(verbose))
+        except OSError as error:
+            c4.disconnect()
+            print("Error: could not listen on {}:{}: {}".format(
+                self.host, self.port, error), file=sys.stderr)
+            sys.exit(1)
+
+        verbose and print("Serving on http://{}:{}/".format(self.host, self.port),
+                          file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            c4.disconnect()
+# }}}1
+
+class Exporter: # {{{1
+    """ Serve the state of the club and how long c4ctrl operations take as
+        metrics in the Prometheus text format on http://HOST:PORT/metrics.
+
+        The state is kept up to date via subscriptions, scrapes never ask the
+        broker. The responce is rendered again in the background after
+        something changed, scrapes only return the last rendering.
+        Metrics are:
+            c4_club_open                        1 if the club is open
+            c4_switches{room}                   light switches as bitmask
+                                                (first switch is the highest
+                                                bit, like with -W)
+            c4_kitchenlight_power               1 if the Kitchenlight is on
+            c4_kitchenlight_screen              ID of the Kitchenlight screen
+            c4_dmx_brightness{room,light}       brightness of a LED can (0..1)
+            c4ctrl_operation_duration_seconds   histograms, see Metrics
+
+        The exporter runs in the background. Operations of other functions
+        running in the same process (eg. --serve or --rules) are measured as
+        well. """
+
+    # Seconds between renderings of the responce while messages keep
+    # coming in, and between looking for new Metrics otherwise.
+    interval = 1
+
+    def __init__(self, host="localhost", port=9100):
+        from threading import Event
+
+        self.host = host
+        self.port = port
+        self.kl = Kitchenlight()
+        self.payloads = {} # Last payload by topic.
+        self._changes = 0
+        self._changed = Event() # Set when a payload changed.
+        self._rendered = None # (changes, Metrics.version) of self._body.
+        self._body = b''
+        self._lock = Lock()
+        self._server = None
+
+    def _topics(self):
+        topics = ["club/status", self.kl.topic, self.kl.powertopic]
+        for room in C4Room.__subclasses__():
+            topics.extend(topic for label, topic in room.switches)
+            topics.extend(light.topic for light in room.lights)
+        return topics
+
+    def _on_message(self, message):
+        with self._lock:
+            if self.payloads.get(message.topic) != message.payload:
+                self.payloads[message.topic] = message.payload
+                self._changes += 1
+                self._changed.set()
+
+    def _brightness(self, light, payload):
+        """ Returns the brightness (0..1) of a LED can showing payload. """
+
+        if len(payload) < 3: return 0.0
+        brightness = max(payload[:3]) / 255
+        if len(light.template) > 6 and len(payload) == len(light.template) // 2:
+            # The last byte is the dimmer.
+            brightness *= payload[-1] / 255
+        return round(brightness, 4)
+
+    def _render(self, payloads):
+        """ Returns the metrics for payloads (by topic) as text. """
+
+        lines = []
+        def gauge(name, help, samples):
+            if not samples: return
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append("{}{} {}".format(name,
+                                              labels and "{" + labels + "}", value))
+
+        status = payloads.get("club/status")
+        gauge("c4_club_open", "Whether the club is open.",
+              status is not None and [((), int(status == b'\x01'))])
+
+        switches = []
+        for room in C4Room.__subclasses__():
+            states = [payloads.get(topic) for label, topic in room.switches]
+            if None in states: continue
+            bits = "".join(str(int.from_bytes(s, sys.byteorder)) for s in states)
+            switches.append(((("room", room.name),), int(bits, 2)))
+        gauge("c4_switches", "Light switches of a room as bitmask.", switches)
+
+        power = payloads.get(self.kl.powertopic)
+        gauge("c4_kitchenlight_power", "Whether the Kitchenlight is on.",
+              power is not None and [((), int(power != b'\x00'))])
+        screen = payloads.get(self.kl.topic)
+        gauge("c4_kitchenlight_screen", "ID of the screen of the Kitchenlight.",
+              screen and [((), int.from_bytes(screen[:4], Kitchenlight._END))])
+
+        brightness = []
+        for room in C4Room.__subclasses__():
+            for light in room.lights:
+                if light.topic in payloads:
+                    brightness.append(((("room", room.name),
+                                        ("light", light.topic.rsplit('/', 1)[-1])),
+                                       self._brightness(light, payloads[light.topic])))
+        gauge("c4_dmx_brightness", "Brightness of a LED can (0..1).", brightness)
+
+        lines.extend(Metrics.exposition("c4ctrl_operation_duration_seconds"))
+        return "\n".join(lines) + "\n"
+
+    def _update(self):
+        """ Render the responce again if anything changed since the last
+            time. """
+
+        with self._lock:
+            version = (self._changes, Metrics.version)
+            if version == self._rendered: return
+            payloads = self.payloads.copy()
+        # Don't hold up incoming messages while rendering.
+        body = self._render(payloads).encode()
+        with self._lock:
+            self._body, self._rendered = body, version
+
+    def _refresh(self):
+        """ Keep the responce up to date, see interval. """
+
+        from time import sleep
+
+        while True:
+            changed = self._changed.wait(self.interval)
+            self._changed.clear()
+            self._update()
+            # Let further messages pile up before rendering again.
+            if changed: sleep(self.interval)
+
+    def body(self):
+        """ Returns the current responce. """
+
+        with self._lock:
+            return self._body
+
+    def _handler(self, verbose=False):
+        """ Returns a request handler class for http.server. """
+
+        from http.server import BaseHTTPRequestHandler
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            server_version = "c4ctrl"
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.body()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if verbose:
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        return Handler
+
+    def start(self, verbose=False):
+        """ Subscribe to the state of the club and start serving in the
+            background. """
+
+        from http.server import ThreadingHTTPServer
+        from threading import Thread
+
+        Metrics.enabled = True
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port),
+                                               self._handler(verbose))
+        except OSError as error:
+            print("Error: could not listen on {}:{}: {}".format(
+                self.host, self.port, error), file=sys.stderr)
+            sys.exit(1)
+        C4Interface().subscribe(self._topics(), self._on_message)
+        self._update()
+        Thread(target=self._refresh, daemon=True).start()
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        verbose and print("Serving metrics on http://{}:{}/metrics".format(
+                          self.host, self.port), file=sys.stderr)
+
+    def run(self, verbose=False):
+        """ Serve until interrupted. """
+
+        from time import sleep
+
+        if self._server is None:
+            self.start(verbose)
+        try:
+            while True:
+                sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            C4Interface().disconnect()
+# }}}1
+
+class Prober: # {{{1
+    """ Measure the latency of the broker(s), to tell a slow network apart
+        from a slow c4ctrl.
+
+        Publishes numbered probes (not retained) to a topic only we
+        subscribed to via the persistent connection and measures how long
+        they take to come back. Also measures how long opening a connection
+        takes. Every broker configured is probed, results are kept in a
+        Histogram per broker. """
+
+    topic = "c4ctrl/probe/"
+    # Number of connections to open for measuring the connect time.
+    connects = 5
+
+    def __init__(self, count=100, interval=0.1):
+        from threading import Condition
+
+        self.count = count
+        self.interval = interval
+        self.c4 = C4Interface()
+        self.topic = Prober.topic + self.c4.client_id
+        endpoints = self.c4._endpoints()
+        self.connect_times = [Histogram() for e in endpoints]
+        self.round_trips = [Histogram() for e in endpoints]
+        self._sent = [{} for e in endpoints] # {sequence number: monotonic()}
+        self._received = [set() for e in endpoints]
+        self._done = Condition()
+
+    def _sample_connect(self, index, host, port):
+        """ Returns the seconds it took to connect to a broker (until it
+            acknowledged the connection). """
+
+        from time import monotonic
+        from threading import Event
+        from paho.mqtt import client as mqtt
+
+        connected = Event()
+        result = [None] # rc of the CONNACK.
+
+        def on_connect(client, userdata, flags, rc):
+            result[0] = rc
+            connected.set()
+
+        # Don't take over the session of the persistent connection.
+        client = mqtt.Client(client_id="{}-{}".format(self.c4.client_id, index))
+        client.on_connect = on_connect
+        start = monotonic()
+        client.connect(host, port)
+        client.loop_start()
+        try:
+            if not connected.wait(self.c4.timeout) \
+                    or result[0] != mqtt.CONNACK_ACCEPTED:
+                # Refused connections are no samples.
+                self.c4._refused(result[0])
+            return monotonic() - start
+        finally:
+            client.disconnect()
+            client.loop_stop()
+
+    def _receiver(self, index, verbose=False):
+        """ Returns a subscription callback measuring probes from broker
+            index. """
+
+        from time import monotonic
+
+        def receive(message):
+            now = monotonic()
+            try:
+                sequence = int(message.payload)
+            except ValueError:
+                return
+            with self._done:
+                sent = self._sent[index].get(sequence)
+                if sent is None or sequence in self._received[index]: return
+                self._received[index].add(sequence)
+                self._done.notify_all()
+            if sequence == 0: return # Only used to warm up.
+            self.round_trips[index].record(now - sent)
+            Metrics.enabled and Metrics.observe("probe", now - sent)
+            verbose and print("{}:{} probe {}: {:.2f} ms".format(
+                *self.c4._endpoints()[index], sequence, (now - sent) * 1000),
+                file=sys.stderr)
+        return receive
+
+    def _probe(self, clients, sequence):
+        """ Publish probe <sequence> to every broker. """
+
+        from time import monotonic
+
+        payload = str(sequence).encode()
+        for index, client in enumerate(clients):
+            if not client: continue
+            with self._done:
+                self._sent[index][sequence] = monotonic()
+            client.publish(self.topic, payload, self.c4.qos, retain=False)
+
+    def _wait(self, clients, sequence, timeout):
+        """ Wait until every broker returned all probes up to sequence. """
+
+        with self._done:
+            return self._done.wait_for(lambda: all(
+                len(self._received[i]) == len(self._sent[i]) >= sequence + 1
+                for i, client in enumerate(clients) if client), timeout)
+
+    def run(self, verbose=False):
+        """ Probe until done or interrupted and print the results.
+
+            Returns False if not a single probe came back. """
+
+        from time import monotonic, sleep
+
+        if self.c4.debug:
+            print("[DEBUG] inhibited probing of {}".format(", ".join(
+                "{}:{}".format(*e) for e in self.c4._endpoints())), file=sys.stderr)
+            return True
+
+        endpoints = self.c4._endpoints()
+        # Keep a persistent connection used by others (eg. --metrics) open.
+        persistent = bool(C4Interface._clients)
+        receivers = []
+        try:
+            for unused in range(self.connects):
+                results = self.c4._fan_out(self._sample_connect)
+                self.c4._check_errors(results)
+                for index, result in enumerate(results):
+                    if not isinstance(result, Exception):
+                        self.connect_times[index].record(result)
+
+            self.c4.connect()
+            with C4Interface._lock:
+                clients = C4Interface._clients.copy()
+            for index, client in enumerate(clients):
+                if client:
+                    receivers.append((index, self._receiver(index, verbose)))
+                    self.c4.subscribe(self.topic, receivers[-1][1], broker=index)
+
+            # The subscriptions have taken effect once the broker returns a
+            # warm up probe, which is not counted (and repeated if lost).
+            deadline = monotonic() + self.c4.timeout
+            while True:
+                self._probe(clients, 0)
+                if self._wait(clients, 0, min(1, deadline - monotonic())):
+                    break
+                if monotonic() >= deadline:
+                    print("Warning: no probe came back within {} seconds".format(
+                        self.c4.timeout), file=sys.stderr)
+                    break
+
+            start = monotonic()
+            for sequence in range(1, self.count + 1):
+                wait = start + (sequence - 1) * self.interval - monotonic()
+                if wait > 0: sleep(wait)
+                self._probe(clients, sequence)
+            # Give the last probes a chance to come back.
+            self._wait(clients, self.count, self.c4.timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for index, receiver in receivers:
+                self.c4.unsubscribe(self.topic, receiver, broker=index)
+            if not persistent:
+                self.c4.disconnect()
+
+        received = 0
+        for index, (host, port) in enumerate(endpoints):
+            sent = max(0, len(self._sent[index]) - 1)
+            lost = sent - len(self.round_trips[index])
+            received += len(self.round_trips[index])
+            print("Broker {}:{}".format(host, port))
+            print("  connect    {:>5} samples          {}".format(
+                len(self.connect_times[index]), self.connect_times[index].summary()))
+            print("  round trip {:>5} samples {:>3} lost  {}".format(
+                len(self.round_trips[index]), lost, self.round_trips[index].summary()))
+        return received > 0
+# }}}1
+
+class AudioEngine: # {{{1
+    """ Let the LED cans of rooms react to music.
+
+        Reads PCM audio from a WAV file or stdin (a WAV stream or raw signed
+        16 bit little endian mono samples at 44.1 kHz, which other files may
+        not contain). For every frame the
+        spectrum of the latest <size> samples is split into one frequency
+        band per light, the lowest frequencies going to the first light of
+        the first room. Each light shows the color of its band (red for bass
+        up to violet for treble), as bright as the band is loud compared to
+        how loud it has been recently.
+
+        Frames are sent as a single batch at most <fps> times per second and
+        not faster than the rate limit of the lights allows, only changed
+        lights are sent. Frames are skipped rather than sent late if we fall
+        behind. The FFT uses numpy if available. """
+
+    fps = 25
+    # Samples per FFT, a power of 2.
+    size = 1024
+    # Frequency range (Hz) split into bands.
+    lowest = 40
+    highest = 12000
+    # Seconds for a band to fade to half its brightness once it got quiet.
+    release = 0.15
+    # Seconds for a band to forget half of the loudest level it has seen.
+    adapt = 4.0
+    # Level (relative to full scale) below which a band stays dark.
+    floor = 0.001
+    # Brightness steps, fewer steps mean fewer messages.
+    steps = 32
+
+    def __init__(self, rooms=None, fps=None):
+        from colorsys import hsv_to_rgb
+        from math import cos, pi, sin
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.numpy = numpy
+
+        self.rooms = rooms or [r for r in C4Room.__subclasses__() if r.lights]
+        self.lights = [light for room in self.rooms for light in room.lights
+                       if not light.is_master]
+        # Keep below the rate limit of the lights.
+        self.fps = fps or self.fps
+        limiter = RateLimiter(C4Interface.rate_limits)
+        for light in self.lights:
+            bucket = limiter._bucket(light.topic)
+            if bucket:
+                users = sum(limiter._bucket(l.topic) is bucket for l in self.lights)
+                self.fps = min(self.fps, bucket[0] / users)
+
+        count = len(self.lights)
+        self.colors = [hsv_to_rgb(0.75 * i / max(1, count - 1), 1, 1)
+                       for i in range(count)]
+        self.window = [0.5 - 0.5 * cos(2 * pi * i / self.size)
+                       for i in range(self.size)]
+        if numpy:
+            self.window = numpy.array(self.window)
+        else:
+            # Bit reversed indices and twiddle factors for _fft().
+            bits = self.size.bit_length() - 1
+            self._reversed = [int("{:0{}b}".format(i, bits)[::-1], 2)
+                              for i in range(self.size)]
+            self._twiddles = {}
+            half = 1
+            while half < self.size:
+                self._twiddles[half] = [complex(cos(pi * k / half), -sin(pi * k / half))
+                                        for k in range(half)]
+                half *= 2
+
+    def _open(self, filename):
+        """ Returns (read(frames), sample rate, channels, sample width) for
+            filename ('-' for stdin). """
+
+        import wave
+
+        fd = sys.stdin.buffer if filename == '-' else open(filename, "rb")
+        header = fd.peek(4)[:4] if hasattr(fd, "peek") else b''
+        if header != b"RIFF":
+            if fd is not sys.stdin.buffer:
+                # Playing eg. an mp3 as raw samples would only be noise.
+                fd.close()
+                raise wave.Error("not a WAV file")
+            # Raw samples.
+            return (lambda frames: fd.read(frames * 2)), 44100, 1, 2
+        audio = wave.open(fd)
+        if audio.getsampwidth() not in (1, 2, 4):
+            raise wave.Error("unsupported sample width of {} bytes".format(
+                audio.getsampwidth()))
+        return (audio.readframes, audio.getframerate(), audio.getnchannels(),
+                audio.getsampwidth())
+
+    def _decode(self, data, channels, width):
+        """ Returns the samples of the first channel in data scaled to
+            -1..1. """
+
+        data = data[:len(data) // (channels * width) * channels * width]
+        if self.numpy:
+            dtype = {1: "u1", 2: "<i2", 4: "<i4"}[width]
+            samples = self.numpy.frombuffer(data, dtype)[::channels].astype(float)
+        else:
+            from array import array
+            samples = array({1: "B", 2: "h", 4: "i" if array("i").itemsize == 4
+                             else "l"}[width])
+            samples.frombytes(data)
+            if sys.byteorder == "big" and width > 1:
+                samples.byteswap()
+            samples = samples[::channels]
+        if width == 1:
+            # 8 bit samples are unsigned.
+            return [(s - 128) / 128 for s in samples] if not self.numpy \
+                else (samples - 128) / 128
+        scale = 1 << (8 * width - 1)
+        return samples / scale if self.numpy else [s / scale for s in samples]
+
+    def _fft(self, values):
+        """ Returns the discrete Fourier transform of values (<size> of them)
+            using an iterative radix-2 FFT. """
+
+        x = [values[i] for i in self._reversed]
+        n = len(x)
+        half = 1
+        while half < n:
+            twiddles = self._twiddles[half]
+            for start in range(0, n, 2 * half):
+                for k in range(half):
+                    a = x[start + k]
+                    b = x[start + k + half] * twiddles[k]
+                    x[start + k] = a + b
+                    x[start + k + half] = a - b
+            half *= 2
+        return x
+
+    def _edges(self, rate):
+        """ Returns the FFT bins the bands start at plus the end of the last
+            band, spaced logarithmically between lowest and highest. """
+
+        count = len(self.lights)
+        bins = self.size // 2
+        edges = []
+        for i in range(count + 1):
+            frequency = self.lowest * (self.highest / self.lowest) ** (i / count)
+            edge = min(bins, max(1, round(frequency * self.size / rate)))
+            # Every band gets at least one bin.
+            edges.append(max(edge, edges[-1] + 1) if edges else edge)
+        return edges
+
+    def bands(self, samples, edges):
+        """ Returns the amplitude of every band in the latest <size>
+            samples. """
+
+        scale = 2 / (self.size / 2) # Full scale sine becomes about 1.
+        if self.numpy:
+            np = self.numpy
+            power = np.abs(np.fft.rfft(samples * self.window)) ** 2
+            total = np.concatenate(([0.0], np.cumsum(power)))
+            return list(np.sqrt(total[edges[1:]] - total[edges[:-1]]) * scale)
+
+        spectrum = self._fft([s * w for s, w in zip(samples, self.window)])
+        power = [abs(c) ** 2 for c in spectrum[:self.size // 2 + 1]]
+        return [sum(power[lo:hi]) ** 0.5 * scale
+                for lo, hi in zip(edges[:-1], edges[1:])]
+
+    def frame(self, amplitudes, state, elapsed):
+        """ Returns the payload of every light for the band amplitudes.
+            state keeps [peak, level] of every band between frames,
+            elapsed is the time since the last frame in seconds. """
+
+        adapt = 0.5 ** (elapsed / self.adapt)
+        release = 0.5 ** (elapsed / self.release)
+        payloads = []
+        for i, amplitude in enumerate(amplitudes):
+            peak, level = state[i]
+            peak = max(amplitude, peak * adapt, self.floor)
+            level = max(amplitude / peak, level * release)
+            state[i] = [peak, level]
+            brightness = round(level * self.steps) / self.steps
+            color = "".join("{:02x}".format(round(c * brightness * 255))
+                            for c in self.colors[i])
+            payloads.append(self.lights[i].payload(color))
+        return payloads
+
+    def _meter(self, position, levels):
+        """ Print a line showing the level of every band. """
+
+        blocks = " ▁▂▃▄▅▆▇█"
+        print("{:8.2f}s {}".format(position, "".join(
+            blocks[min(8, round(level * 8))] for level in levels)),
+            file=sys.stderr)
+
+    def run(self, filename, speed=1.0, verbose=False):
+        """ Play filename ('-' for stdin) on the lights until it ends or
+            we are interrupted. speed speeds up files, 0 is as fast as
+            possible.
+
+            Returns False if filename could not be read. """
+
+        import wave
+        from time import monotonic, sleep
+
+        try:
+            read, rate, channels, width = self._open(filename)
+        except (OSError, EOFError, wave.Error) as error:
+            print("Error: could not read audio \"{}\": {}".format(filename, error),
+                  file=sys.stderr)
+            return False
+        if not self.lights:
+            print("Error: there are no lights to play on!", file=sys.stderr)
+            return False
+
+        hop = max(1, round(rate / self.fps))
+        period = hop / rate
+        edges = self._edges(rate)
+        if self.numpy:
+            edges = self.numpy.array(edges)
+            buffer = self.numpy.zeros(self.size)
+        else:
+            buffer = [0.0] * self.size
+        state = [[self.floor, 0.0] for light in self.lights]
+        sent = [None] * len(self.lights)
+        verbose and print("Playing {} Hz audio on {} lights at {:.1f} frames per \
+second{}".format(rate, len(self.lights), 1 / period,
+                 " (numpy)" if self.numpy else ""), file=sys.stderr)
+
+        c4 = C4Interface()
+        persistent = bool(C4Interface._clients)
+        c4.connect()
+        index = skipped = 0
+        start = None
+        try:
+            while True:
+                data = read(hop)
+                if not data: break
+                if start is None: start = monotonic()
+                samples = self._decode(data, channels, width)
+                if self.numpy:
+                    buffer = self.numpy.concatenate((buffer, samples))[-self.size:]
+                else:
+                    buffer = (buffer + samples)[-self.size:]
+                index += 1
+
+                if speed:
+                    due = start + index * period / speed
+                    wait = due - monotonic()
+                    if wait > 0:
+                        sleep(wait)
+                    elif wait < -period / speed:
+                        # Catch up instead of lagging behind.
+                        skipped += 1
+                        continue
+
+                amplitudes = self.bands(buffer, edges)
+                payloads = self.frame(amplitudes, state, period)
+                verbose and self._meter(index * period,
+                                        [level for peak, level in state])
+                changed = [(light.topic, payload) for light, payload, last
+                           in zip(self.lights, payloads, sent) if payload != last]
+                if changed:
+                    c4.push(changed)
+                    sent = payloads
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not persistent:
+                c4.disconnect()
+        if skipped:
+            print("Warning: skipped {} of {} frames to keep up".format(
+                skipped, index), file=sys.stderr)
+        return True
+# }}}1
+
+class ScheduleEntry: # {{{1
+    """ Actions to run at certain times, see Scheduler. """
+
+    weekdays = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+    def __init__(self, name, at, actions, days=None, catchup="last"):
+        """ name = name of the entry
+            at = time like "19:00" (daily) or "2026-12-24 18:00" (once)
+            actions = list of Actions to run
+            days = weekdays like "mon-fri" or "sat, sun" (default: every day)
+            catchup = what to do about runs missed while the scheduler was
+                      not running: "skip" them, run the "last" one only
+                      (default) or run "all" of them """
+
+        from datetime import datetime
+
+        self.name = name
+        self.actions = actions
+
+        at = at.strip()
+        if ' ' in at:
+            self.once = datetime.strptime(at, "%Y-%m-%d %H:%M")
+            self.time = self.once.time()
+        else:
+            self.once = None
+            self.time = datetime.strptime(at, "%H:%M").time()
+
+        # Parse days into a set of weekday numbers (0 = monday).
+        self.days = set(range(7))
+        if days:
+            self.days = set()
+            for part in days.lower().replace(' ', '').split(','):
+                first, sep, last = part.partition('-')
+                try:
+                    day = self.weekdays.index(first[:3])
+                    end = self.weekdays.index((last or first)[:3])
+                except ValueError:
+                    raise ValueError("invalid days \"{}\"".format(days))
+                self.days.add(day)
+                while day != end:
+                    day = (day + 1) % 7
+                    self.days.add(day)
+
+        if catchup not in ("skip", "last", "all"):
+            raise ValueError("invalid catchup policy \"{}\"".format(catchup))
+        self.catchup = catchup
+
+    def next_after(self, t):
+        """ Returns the time (in seconds since the epoch) this entry is due
+            next after time t or None if it will never be due again. """
+
+        from datetime import datetime, timedelta
+
+        if self.once:
+            when = self.once.timestamp()
+            return when if when > t else None
+
+        day = datetime.fromtimestamp(t).date()
+        for i in range(8):
+            date = day + timedelta(days=i)
+            if date.weekday() not in self.days: continue
+            when = datetime.combine(date, self.time).timestamp()
+            if when > t: return when
+        return None
+
+    def missed(self, last, now):
+        """ Returns the times this entry should be run to catch up on runs
+            missed between last and now, according to its catchup policy. """
+
+        if self.catchup == "skip": return []
+
+        times = []
+        when = self.next_after(last)
+        while when is not None and when <= now:
+            times.append(when)
+            if self.catchup == "last": times = times[-1:]
+            when = self.next_after(when)
+        return times
+# }}}1
+
+class Scheduler: # {{{1
+    """ Run actions at given times.
+
+        Entries are read from a file like this (one section per entry):
+            [plenarsaal evening]
+            at = 19:00
+            days = mon-fri
+            action = preset plenar evening
+
+            [lights off]
+            at = 02:00
+            catchup = skip
+            action = switch wohnzimmer 0
+                     switch plenar 0
+
+        See ScheduleEntry for the available options and Action for the
+        available actions. The time up to which every entry has been taken
+        care of is kept in a state file next to it (with ".state" appended),
+        so runs missed while c4ctrl was not running can be caught up on. """
+
+    # Name of the default schedule in the config directory.
+    filename = "schedule"
+    # Runs overdue by more than this many seconds (after a suspend or when
+    # the clock was changed) were missed and follow the catchup policy.
+    grace = 60
+
+    def __init__(self, filename=None):
+        self.entries = []
+        self.statefile = None
+        self.state = {} # Time up to which an entry was taken care of by name.
+        self._heap = [] # (time, sequence number, entry, reschedule) tuples.
+        self._seq = 0 # Keeps entries due at the same time in order.
+        if filename:
+            self.load(filename)
+
+    def load(self, filename):
+        """ Load entries from filename. Returns False on errors. """
+
+        import configparser, json
+
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            if not parser.read(filename):
+                print("Error: could not read schedule \"{}\"!".format(filename),
+                      file=sys.stderr)
+                return False
+        except configparser.Error as error:
+            print("Error: {}".format(error), file=sys.stderr)
+            return False
+
+        for name in parser.sections():
+            section = parser[name]
+            try:
+                actions = [Action(line) for line
+                           in section.get("action", "").splitlines() if line.strip()]
+                if not actions:
+                    raise ValueError("no action given")
+                self.entries.append(ScheduleEntry(name, section["at"], actions,
+                        days=section.get("days"),
+                        catchup=section.get("catchup", "last")))
+            except (KeyError, ValueError) as error:
+                print("Error in entry \"{}\": {}".format(name, error), file=sys.stderr)
+                return False
+
+        self.statefile = filename + ".state"
+        try:
+            with open(self.statefile) as fd:
+                self.state = json.load(fd)
+        except (OSError, ValueError):
+            self.state = {}
+        return True
+
+    def _save_state(self):
+        """ Write the state file (atomically). """
+
+        import json, os
+
+        if C4Interface.debug or not self.statefile: return
+        tmp = self.statefile + ".tmp"
+        with open(tmp, "w") as fd:
+            json.dump(self.state, fd, indent=1, sort_keys=True)
+        os.replace(tmp, self.statefile)
+
+    def _push(self, when, entry, reschedule=True):
+        """ Queue entry to be run at when. """
+
+        import heapq
+
+        if when is not None:
+            self._seq += 1
+            heapq.heappush(self._heap, (when, self._seq, entry, reschedule))
+
+    def plan(self, now=None):
+        """ Fill the queue with the next run of every entry and the runs
+            missed since the last time the scheduler was running. """
+
+        from time import time
+
+        now = now or time()
+        self._heap = []
+        for entry in self.entries:
+            last = self.state.get(entry.name)
+            if last is not None:
+                for when in entry.missed(last, now):
+                    self._push(when, entry, reschedule=False)
+            self._push(entry.next_after(now), entry)
+
+    def execute(self, entry, verbose=False):
+        """ Run the actions of entry. """
+
+        verbose and print("Running \"{}\".".format(entry.name), file=sys.stderr)
+        for action in entry.actions:
+            try:
+                action.run()
+            except SystemExit:
+                # Some commands exit on errors. Let's not stop the scheduler.
+                print("Error: action \"{}\" of \"{}\" failed!".format(
+                    action.line, entry.name), file=sys.stderr)
+            except Exception as error:
+                # Nor on a bad color or an unreachable broker.
+                print("Error: action \"{}\" of \"{}\" failed: {}".format(
+                    action.line, entry.name, error), file=sys.stderr)
+
+    def run(self, verbose=False):
+        """ Run entries when they are due until interrupted. """
+
+        import heapq
+        from time import localtime, sleep, strftime, time
+
+        self.plan()
+        if C4Interface.debug:
+            for when, seq, entry, reschedule in sorted(self._heap)[:20]:
+                print("[DEBUG] {} {}".format(
+                    strftime("%Y-%m-%d %H:%M", localtime(when)), entry.name),
+                    file=sys.stderr)
+            return
+
+        # Entries seen for the first time have nothing to catch up on.
+        now = time()
+        for entry in self.entries:
+            self.state.setdefault(entry.name, now)
+        self._save_state()
+
+        c4 = C4Interface()
+        c4.connect()
+        try:
+            while True:
+                now, ran = time(), False
+                while self._heap and self._heap[0][0] <= now:
+                    when, seq, entry, reschedule = heapq.heappop(self._heap)
+                    if reschedule and now - when > self.grace:
+                        # Missed while suspended or the clock jumped ahead.
+                        for missed in entry.missed(when - 1, now):
+                            self.execute(entry, verbose)
+                    else:
+                        self.execute(entry, verbose)
+                    if reschedule:
+                        self._push(entry.next_after(max(when, now)), entry)
+                    self.state[entry.name] = now
+                    ran = True
+                if ran: self._save_state()
+
+                if not self._heap: break # Nothing left to do.
+                # Wake up at least once a minute, the clock may have been
+                # changed or the machine suspended.
+                sleep(min(max(self._heap[0][0] - time(), 0), 60))
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            c4.disconnect()
+# }}}1
+
+class Coprocess: # {{{1
+    """ Answer requests read from stdin, allowing c4ctrl.vim to talk to
+        c4ctrl without blocking.
+
+        Requests and responces are JSON objects, one per line. Responces
+        carry the "id" of their request and either the results or "error".
+            {"id": 1, "command": "get"}
+                -> {"id": 1, "preset": TEXT}
+            {"id": 2, "command": "set", "preset": TEXT, "rooms": ["w"],
+             "minimal": true}
+                -> {"id": 2, "sent": 3}
+        "get" returns the current state of all lights in the preset file
+        format. "set" applies TEXT to rooms (default: all rooms with LED
+        cans) and returns the number of messages sent. With "minimal", only
+        colors which changed since the last "set" are sent; the first one
+        compares with the state of the club. """
+
+    def __init__(self):
+        self.colors = None # Colors sent by topic.
+
+    def get(self, request):
+        import io
+
+        fd = io.StringIO()
+        ColorScheme().write(fd)
+        return {"preset": fd.getvalue()}
+
+    def set(self, request):
+        colorscheme = ColorScheme()
+        colorscheme.from_text(str(request.get("preset", "")))
+        rooms = [Action._expand_room(str(r)) for r in request.get("rooms") or []]
+        rooms = rooms or [Wohnzimmer, Plenarsaal, Fnordcenter]
+
+        minimal, current = bool(request.get("minimal")), None
+        if minimal and self.colors is not None:
+            current = ColorScheme()
+            current.mapping = self.colors
+        command = [c for room, cmd in plan_transition(colorscheme, rooms,
+                                                      minimal, current)
+                   for c in cmd]
+        if command:
+            C4Interface().push(command)
+
+        if self.colors is None: self.colors = {}
+        for room in rooms:
+            for light in room.lights:
+                color = colorscheme.get_color_for(light.topic)
+                if color: self.colors[light.topic] = color
+        return {"sent": len(command)}
+
+    def run(self):
+        """ Answer requests until stdin is closed. """
+
+        import json
+
+        # Keep stdout to ourselves, anything else printed goes to stderr.
+        out = sys.stdout
+        sys.stdout = sys.stderr
+
+        c4 = C4Interface()
+        c4.connect()
+        try:
+            for line in sys.stdin:
+                if not line.strip(): continue
+                request, command = {}, None
+                try:
+                    request = json.loads(line)
+                    command = request.get("command")
+                    if command not in ("get", "set"):
+                        raise ValueError("unknown command \"{}\"".format(command))
+                    responce = getattr(self, command)(request)
+                except SystemExit:
+                    # Errors have already been printed.
+                    responce = {"error": "{} failed".format(command)}
+                except Exception as error:
+                    responce = {"error": str(error)}
+                responce["id"] = request.get("id") if type(request) == dict else None
+                out.write(json.dumps(responce) + "\n")
+                out.flush()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            sys.stdout = out
+            c4.disconnect()
+# }}}1
+
+class Completion: # {{{1
+    """ Candidates for shell completion, fast enough to be called on every
+        press of <TAB>.
+
+        Remote presets would need a round trip to the broker, so they are
+        read from a cache file which is refreshed by a detached c4ctrl
+        process once it is older than max_age seconds. Until then, stale (or
+        no) candidates are returned. Neither answering nor starting the
+        refresh imports paho. Shells should call c4complete, which imports
+        this module (with its bytecode cached) instead of running the
+        script. """
+
+    # Seconds after which the cache gets refreshed.
+    max_age = 600
+
+    def __init__(self):
+        import os
+
+        if "XDG_CACHE_HOME" in os.environ:
+            cache_home = os.environ["XDG_CACHE_HOME"]
+        else:
+            cache_home = os.path.expanduser(os.path.join("~", ".cache"))
+        self.filename = os.path.join(cache_home, "c4ctrl", "completion.json")
+
+    def _load(self):
+        """ Returns the cached data, starting a refresh if it is stale. """
+
+        import json, os, time
+
+        try:
+            age = time.time() - os.stat(self.filename).st_mtime
+            with open(self.filename) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            age, data = None, {}
+
+        if age is None or age > self.max_age:
+            self._spawn_refresh()
+        return data
+
+    def _save(self, data):
+        import json, os
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as fd:
+            json.dump(data, fd)
+        os.replace(tmp, self.filename)
+
+    def _spawn_refresh(self):
+        """ Start a detached 'c4ctrl --complete refresh'. """
+
+        import os, subprocess
+
+        # Keep further completions from starting another refresh meanwhile
+        # (and from hammering an unreachable broker).
+        try:
+            if os.path.exists(self.filename):
+                os.utime(self.filename)
+            else:
+                self._save({})
+        except OSError:
+            return
+
+        # We may have been imported by c4complete, run c4ctrl.py itself.
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--complete", "refresh"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def refresh(self):
+        """ Query remote presets of all rooms and write the cache file. """
+
+        import time
+
+        c4 = C4Interface()
+        c4.load_config()
+        rooms = list(RemotePresets().map.keys())
+        # Pull via a persistent connection, which gives up after c4.timeout
+        # seconds if some lists are not retained.
+        c4.connect()
+        try:
+            available = RemotePresets().query_available(rooms)
+        finally:
+            c4.disconnect()
+        if not available: return False
+        self._save({"time": time.time(), "remote": available})
+        return True
+
+    def candidates(self, kind, *args):
+        """ Returns a list of candidates.
+
+            kind is one of:
+                presets         -- local presets
+                remote [ROOM]   -- remote presets (of all rooms or for ROOM)
+                rooms           -- rooms for remote presets
+                kl-modes        -- Kitchenlight modes """
+
+        if kind == "presets":
+            return ColorScheme().available_presets(ignore_missing=True)
+
+        elif kind == "remote":
+            remote = self._load().get("remote", {})
+            if args:
+                room = RemotePresets()._expand_room_name(args[0])
+                rooms = ["global", room]
+            else:
+                rooms = list(remote.keys())
+            found = []
+            for room in rooms:
+                found.extend(p for p in remote.get(room, []) if p not in found)
+            return found
+
+        elif kind == "rooms":
+            return list(RemotePresets().map.keys())
+
+        elif kind == "kl-modes":
+            return Kitchenlight.modes.copy()
+
+        else:
+            raise ValueError("unknown kind \"{}\"".format(kind))
+
+    def main(self, args):
+        """ Entry point for 'c4ctrl --complete KIND [ARG]'. Prints one
+            candidate per line and returns the exit status. """
+
+        if args[:1] == ["refresh"]:
+            return 0 if self.refresh() else 1
+
+        try:
+            for candidate in self.candidates(*args):
+                print(candidate)
+        except (TypeError, ValueError) as error:
+            print("Error: {}!".format(error), file=sys.stderr)
+            return 1
+        return 0
+# }}}1
+
+class Simulator: # {{{1
+    """ A stand-in for the AutoC4 broker, for testing without the club.
+
+        The simulator speaks enough MQTT 3.1.1 for c4ctrl and other simple
+        clients. It keeps retained messages like a broker and mimics AutoC4:
+            - preset/[ROOM/]set applies a remote preset by publishing the DMX
+              payloads it stores, preset/[ROOM/]def stores the current DMX
+              payloads of the room (or all rooms) as preset
+            - club/shutdown turns off all lights, switches and the
+              Kitchenlight
+            - turning power/wohnzimmer/kitchenlight off switches the
+              Kitchenlight screen off
+
+        latency (seconds) delays every packet received, keeping their order
+        but without limiting throughput. loss (0..1) is the probability of
+        dropping any PUBLISH packet, received or delivered.
+        clients is the number of additional idle clients subscribed to
+        every topic, to load the broker like a busy club would.
+
+        Use from tests like this:
+            sim = Simulator(port=0) # Pick a free port.
+            sim.start()
+            C4Interface.broker, C4Interface.port = sim.host, sim.port
+            Plenarsaal().light_switch("1000")
+            ...
+            assert sim.retained["licht/plenar/vornewand"] == b'\\x01'
+            sim.stop() """
+
+    def __init__(self, host="localhost", port=1883, latency=0, loss=0,
+                 clients=0, verbose=False):
+        from random import Random
+
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.clients = clients
+        self.verbose = verbose
+        self.retained = {} # Retained payloads by topic.
+        self.presets = {} # {preset topic prefix: {name: {topic: payload}}}
+        self.received = 0 # Number of PUBLISH packets received.
+        self._sessions = []
+        self._lock = RLock()
+        self._random = Random()
+        self._server = None
+        self._idle = [] # Sockets of the idle clients.
+        self._reset()
+
+    def _rooms(self):
+        return [Wohnzimmer, Plenarsaal, Fnordcenter, Keller]
+
+    def _reset(self):
+        """ Set up the state of a closed club. """
+
+        self.retained["club/status"] = b'\x00'
+        self.retained["power/wohnzimmer/kitchenlight"] = b'\x00'
+        self.retained["kitchenlight/change_screen"] = bytes(4)
+        for room in self._rooms():
+            for name, topic in room.switches:
+                self.retained[topic] = b'\x00'
+            for light in room.lights:
+                self.retained[light.topic] = light.payload("000000")
+        # Every room knows the preset "off".
+        for prefix in ["preset/"] + ["preset/{}/".format(r)
+                                     for r in RemotePresets().map if r != "global"]:
+            self.presets[prefix] = {"off" : {}}
+            self._publish_list(prefix)
+
+    def _room_lights(self, prefix):
+        """ Returns the lights of the room with preset topics starting with
+            prefix (all lights for "preset/"). """
+
+        rooms = {"wohnzimmer" : Wohnzimmer, "plenar" : Plenarsaal,
+                 "fnord" : Fnordcenter, "keller" : Keller}
+        room = prefix[len("preset/"):].rstrip('/')
+        if not room:
+            return [l for r in self._rooms() for l in r.lights]
+        return list(rooms[room].lights) if room in rooms else []
+
+    def _publish_list(self, prefix):
+        import json
+
+        names = sorted(self.presets[prefix])
+        self.retained[prefix + "list"] = json.dumps(names).encode()
+
+    # Encoding and decoding of MQTT packets.
+    def _encode_length(self, length):
+        encoded = bytearray()
+        while True:
+            digit, length = length % 128, length // 128
+            encoded.append(digit | (0x80 if length else 0))
+            if not length: return bytes(encoded)
+
+    def _packet(self, header, body):
+        return bytes([header]) + self._encode_length(len(body)) + body
+
+    def _publish_packet(self, topic, payload, retain=False):
+        import struct
+
+        topic = topic.encode()
+        return self._packet(0x30 | retain,
+                            struct.pack("!H", len(topic)) + topic + payload)
+
+    def _read_packet(self, fd):
+        """ Returns (header, body) of the next packet or None on EOF. """
+
+        header = fd.read(1)
+        if not header: return None
+        length, shift = 0, 0
+        while True:
+            digit = fd.read(1)
+            if not digit: return None
+            length += (digit[0] & 0x7f) << shift
+            shift += 7
+            if not digit[0] & 0x80: break
+        body = fd.read(length)
+        if len(body) < length: return None
+        return header[0], body
+
+    def _strings(self, body, offset, count=None):
+        """ Returns [strings] and the offset after length-prefixed strings
+            each followed by one byte (as in SUBSCRIBE) if count is None. """
+
+        import struct
+
+        strings = []
+        while offset < len(body):
+            length = struct.unpack("!H", body[offset:offset+2])[0]
+            strings.append(body[offset+2:offset+2+length].decode())
+            offset += 2 + length + (1 if count is None else 0)
+        return strings, offset
+
+    # Message routing.
+    def publish(self, topic, payload, retain=False):
+        """ Publish a message to all subscribed clients, like a message
+            received from a client. AutoC4 will react to it. """
+
+        from paho.mqtt.client import topic_matches_sub
+
+        with self._lock:
+            if retain:
+                if payload: self.retained[topic] = payload
+                else: self.retained.pop(topic, None)
+            sessions = self._sessions.copy()
+        self.verbose and print("[SIM] {} = {}{}".format(topic, payload.hex(),
+                               " (retained)" if retain else ""), file=sys.stderr)
+
+        for session in sessions:
+            if any(topic_matches_sub(f, topic) for f in session.filters):
+                self._deliver(session, self._publish_packet(topic, payload))
+
+        self._react(topic, payload)
+
+    def _deliver(self, session, packet):
+        if self.loss and packet[0] >> 4 == 3 and self._random.random() < self.loss:
+            return
+        session.send(packet)
+
+    def _react(self, topic, payload):
+        """ Mimic AutoC4. """
+
+        if topic.startswith("preset/") and topic.endswith(("/set", "/def")):
+            prefix = topic[:-3]
+            if prefix not in self.presets: return
+            name = payload.decode(errors="replace")
+            if topic.endswith("/def"):
+                lights = self._room_lights(prefix)
+                with self._lock:
+                    self.presets[prefix][name] = dict(
+                        (l.topic, self.retained.get(l.topic)) for l in lights)
+                self._publish_list(prefix)
+                self.publish(prefix + "list", self.retained[prefix + "list"], True)
+            else:
+                preset = self.presets[prefix].get(name)
+                if preset is None: return
+                for light in self._room_lights(prefix):
+                    self.publish(light.topic, preset.get(light.topic)
+                                 or light.payload("000000"), True)
+
+        elif topic == "club/shutdown":
+            for room in self._rooms():
+                for light in room.lights:
+                    self.publish(light.topic, light.payload("000000"), True)
+                for name, switch in room.switches:
+                    self.publish(switch, b'\x00', True)
+            self.publish("power/wohnzimmer/kitchenlight", b'\x00', True)
+
+        elif topic == "power/wohnzimmer/kitchenlight" and payload == b'\x00':
+            with self._lock:
+                screen = self.retained.get("kitchenlight/change_screen")
+            if screen != bytes(4):
+                self.publish("kitchenlight/change_screen", bytes(4), True)
+
+    def _handler(self):
+        """ Returns a request handler class for socketserver. """
+
+        import socketserver, struct
+        from queue import Queue
+        from threading import Lock, Thread
+        from time import monotonic, sleep
+
+        simulator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                self.filters = []
+                self._send_lock = Lock()
+
+            def send(self, packet):
+                with self._send_lock:
+                    try:
+                        self.wfile.write(packet)
+                    except OSError:
+                        pass
+
+            def handle(self):
+                with simulator._lock:
+                    simulator._sessions.append(self)
+                if simulator.latency:
+                    # Delay packets without limiting throughput: a worker
+                    # dispatches every packet <latency> after it arrived.
+                    self.queue = Queue()
+                    Thread(target=self.delayed, daemon=True).start()
+                try:
+                    while True:
+                        packet = simulator._read_packet(self.rfile)
+                        if simulator.latency:
+                            self.queue.put((monotonic() + simulator.latency, packet))
+                            if packet is None: break
+                        elif packet is None or not self.dispatch(*packet):
+                            break
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    with simulator._lock:
+                        simulator._sessions.remove(self)
+
+            def delayed(self):
+                while True:
+                    due, packet = self.queue.get()
+                    if packet is None: break
+                    wait = due - monotonic()
+                    if wait > 0: sleep(wait)
+                    try:
+                        if not self.dispatch(*packet): break
+                    except (OSError, ValueError):
+                        break
+
+            def dispatch(self, header, body):
+                kind = header >> 4
+                if kind == 1: # CONNECT
+                    self.send(b'\x20\x02\x00\x00')
+                elif kind == 3: # PUBLISH
+                    qos, retain = (header >> 1) & 3, header & 1
+                    length = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2+length].decode()
+                    offset = 2 + length
+                    if simulator.loss and simulator._random.random() < simulator.loss:
+                        return True # Lost, not even acknowledged.
+                    if qos:
+                        mid = body[offset:offset+2]
+                        offset += 2
+                        self.send((b'\x40\x02' if qos == 1 else b'\x50\x02') + mid)
+                    with simulator._lock:
+                        simulator.received += 1
+                    simulator.publish(topic, body[offset:], bool(retain))
+                elif kind == 6: # PUBREL
+                    self.send(b'\x70\x02' + body[:2])
+                elif kind == 8: # SUBSCRIBE
+                    from paho.mqtt.client import topic_matches_sub
+                    filters, unused = simulator._strings(body, 2)
+                    self.filters.extend(filters)
+                    self.send(simulator._packet(0x90, body[:2] + bytes(len(filters))))
+                    with simulator._lock:
+                        retained = list(simulator.retained.items())
+                    for topic, payload in retained:
+                        if any(topic_matches_sub(f, topic) for f in filters):
+                            simulator._deliver(self, simulator._publish_packet(
+                                topic, payload, retain=True))
+                elif kind == 10: # UNSUBSCRIBE
+                    filters, unused = simulator._strings(body, 2, count=0)
+                    self.filters = [f for f in self.filters if f not in filters]
+                    self.send(b'\xb0\x02' + body[:2])
+                elif kind == 12: # PINGREQ
+                    self.send(b'\xd0\x00')
+                elif kind == 14: # DISCONNECT
+                    return False
+                return True
+
+        return Handler
+
+    def _connect_idle(self):
+        """ Connect an idle client subscribed to every topic. """
+
+        import socket
+        from threading import Thread
+
+        sock = socket.create_connection((self.host, self.port))
+        client_id = "c4sim-idle-{}".format(len(self._idle)).encode()
+        sock.sendall(self._packet(0x10, b'\x00\x04MQTT\x04\x02\x00\x00'
+                     + len(client_id).to_bytes(2, "big") + client_id))
+        sock.sendall(self._packet(0x82, b'\x00\x01\x00\x01#\x00'))
+        self._idle.append(sock)
+
+        def drain():
+            try:
+                while sock.recv(65536): pass
+            except OSError:
+                pass
+        Thread(target=drain, daemon=True).start()
+
+    def start(self):
+        """ Start serving in the background. """
+
+        import socketserver
+        from threading import Thread
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(
+            (self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        for unused in range(self.clients):
+            self._connect_idle()
+
+    def stop(self):
+        """ Stop serving and disconnect all clients. """
+
+        for sock in self._idle:
+            sock.close()
+        self._idle = []
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def run(self):
+        """ Serve until interrupted. """
+
+        from time import sleep
+
+        try:
+            self.start()
+        except OSError as error:
+            print("Error: could not listen on {}:{}: {}".format(
+                self.host, self.port, error), file=sys.stderr)
+            sys.exit(1)
+
+        print("Simulating AutoC4 on {}:{}".format(self.host, self.port),
+              file=sys.stderr)
+        try:
+            while True:
+                sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+# }}}1
+
+if __name__ == "__main__": # {{{1
+    # Answer shell completion before anything else, see Completion.
+    if sys.argv[1:2] == ["--complete"]:
+        sys.exit(Completion().main(sys.argv[2:]))
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Command line client for AutoC4.")
+    parser.add_argument(
+        "-d", "--debug", action="store_true",
+        help="display what would be send to the MQTT broker, but do not \
+        actually connect")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="be more verbose (e.g. print recorded or replayed messages)")
+    parser.add_argument(
+        "--broker", type=str, metavar="HOST[:PORT]",
+        help="connect to the MQTT broker at HOST only, ignoring brokers \
+        configured in c4ctrl.conf")
+    parser.add_argument(
+        "--qos", type=int, choices=(0, 1),
+        help="publish with QoS 1 to have every message acknowledged by the \
+        broker. Unacknowledged messages are reported. (default: 0)")
+    parser.add_argument(
+        "--window", type=int, metavar="N",
+        help="number of QoS 1 messages to send before waiting for their \
+        acknowledgement (default: 20)")
+
+    # Various club functions
+    group_fn = parser.add_argument_group(title="various functions")
+    group_fn.add_argument(
+        "-s", "--status", action="store_true",
+        help="display club status")
+    group_fn.add_argument(
+        "-g", "--gate", action="store_true",
+        help="open club gate")
+    group_fn.add_argument(
+        "-S", "--shutdown", action="count",
+        help="shutdown (give twice to force shutdown)")
+    group_fn.add_argument(
+        "--undo", nargs='?', type=int, const=1, metavar="N",
+        help="undo the last N changes to lights and switches (default: 1)")
+    group_fn.add_argument(
+        "--cyberalert", nargs=1, type=int, metavar="0|1",
+        help="start/stop cyberalert")
+    group_fn.add_argument(
+        "--watch", action="store_true",
+        help="display a live view of lights, switches and the Kitchenlight \
+        until interrupted")
+    group_fn.add_argument(
+        "--rules", type=str, metavar="FILE",
+        help="run the automation rules in FILE until interrupted")
+    group_fn.add_argument(
+        "--batch", type=str, metavar="FILE",
+        help="execute the command lines in FILE ('-' for stdin) using a \
+        single connection (see README)")
+    group_fn.add_argument(
+        "--metrics", type=str, metavar="[HOST:]PORT",
+        help="serve the state of the club and latencies of c4ctrl as \
+        Prometheus metrics. May be combined with other functions.")
+    group_fn.add_argument(
+        "--probe", nargs='?', type=int, const=100, metavar="N",
+        help="measure the latency of the broker(s) by sending N probes \
+        (default: 100)")
+    group_fn.add_argument(
+        "--interval", type=float, default=100, metavar="MS",
+        help="send a probe every MS milliseconds (default: 100)")
+    group_fn.add_argument(
+        # Used by c4ctrl.vim, see Coprocess.
+        "--coprocess", action="store_true", help=argparse.SUPPRESS)
+    group_fn.add_argument(
+        "--schedule", nargs='?', const="", metavar="FILE",
+        help="run the actions scheduled in FILE (default: \"schedule\" in the \
+        config directory) when they are due, until interrupted")
+    group_fn.add_argument(
+        "--serve", type=str, metavar="[HOST:]PORT",
+        help="answer HTTP requests with JSON on PORT until interrupted \
+        (HOST defaults to localhost)")
+
+    # Kitchenlight control
+    group_kl = parser.add_argument_group(title="Kitchenlight control")
+    group_kl.add_argument(
+        "-k", "--kl-mode", nargs='+', type=str, metavar=("MODE", "OPTIONS"),
+        help="set Kitchenlight to MODE (MODE may be abbreviated)")
+    group_kl.add_argument(
+        "-i", "--list-kl-modes", action="store_true",
+        help="list available Kitchenlight modes and their options")
+
+    # Ambient control
+    group_cl = parser.add_argument_group(title="ambient color control",
+        description="PRESET may be either a preset name (which may be \
+        abbreviated), '#' followed by a color value in hex notation (e.g. \
+        \"#ff0066\"), a generator like \"gradient(red, blue)\" (see README) \
+        or '-' to read from stdin.")
+    group_cl.add_argument(
+        "-w", "--wohnzimmer", type=str, dest="w_color", metavar="PRESET",
+        help="apply local colorscheme PRESET to Wohnzimmer")
+    group_cl.add_argument(
+        "-p", "--plenarsaal", type=str, dest="p_color", metavar="PRESET",
+        help="apply local colorscheme PRESET to Plenarsaal")
+    group_cl.add_argument(
+        "-f", "--fnordcenter", type=str, dest="f_color", metavar="PRESET",
+        help="apply local colorscheme PRESET to Fnordcenter")
+    group_cl.add_argument(
+        "-a", "--all-rooms", type=str, dest="a_color", metavar="PRESET",
+        help="apply local colorscheme PRESET to all rooms (may be combined \
+        with '-w', '-p' and '-f' to use a different PRESET for some rooms)")
+    group_cl.add_argument(
+        "--import-presets", nargs='*', metavar="PRESET",
+        help="copy preset files (default: all) into the preset library, \
+        creating it if necessary")
+    group_cl.add_argument(
+        "--export-presets", action="store_true",
+        help="write every preset of the preset library to a preset file")
+    group_cl.add_argument(
+        "-m", "--minimal", action="store_true",
+        help="send only colors which differ from the current state")
+    group_cl.add_argument(
+        "--from", type=str, dest="from_preset", metavar="PRESET",
+        help="assume the lights show PRESET instead of querying their state \
+        (implies '-m'; use with '-d' to see what a transition would send, \
+        or with '-o' to store PRESET, eg. to freeze generated colors)")
+    group_cl.add_argument(
+        "--stagger", type=float, default=0, metavar="SECONDS",
+        help="change rooms one after another, waiting SECONDS in between")
+    group_cl.add_argument(
+        "-l", "--list-presets", action="store_true",
+        help="list locally available presets")
+    group_cl.add_argument(
+        "-o", "--store-preset", type=str, dest="store_as", metavar="NAME",
+        help="store current state as preset NAME ('-' to write to stdout)")
+
+    # Switch control
+    group_sw = parser.add_argument_group(title="light switch control",
+        description="BINARY_CODE is a string of 0s or 1s for every light in a \
+        room. May be given as decimal. May be prepended by '~', '&', '|' or \
+        '^' as NOT, AND, OR and XOR operators. Current switch states will be \
+        printed to stdout if BINARY_CODE is '-'. Will show usage information \
+        and ask for input if BINARY_CODE is omitted. Will read from stdin if \
+        BINARY_CODE \ is omitted and stdin is not connected to a TTY.")
+    group_sw.add_argument(
+        "-W", nargs='?', dest="w_switch", const="", metavar="BINARY_CODE",
+        help="switch lights and sockets in Wohnzimmer on/off")
+    group_sw.add_argument(
+        "-P", nargs='?', dest="p_switch", const="", metavar="BINARY_CODE",
+        help="switch lights in Plenarsaal on/off")
+    group_sw.add_argument(
+        "-F", nargs='?', dest="f_switch", const="", metavar="BINARY_CODE",
+        help="switch lights in Fnordcentter on/off")
+    group_sw.add_argument(
+        "-K", nargs='?', dest="k_switch", const="", metavar="BINARY_CODE",
+        help="switch lights in Keller on/off")
+
+    # Remote presets
+    group_rp = parser.add_argument_group(title="remote preset functions",
+        description="Available room names are \"wohnzimmer\", \"plenar\", \
+        \"fnord\" and \"keller\". Preset and room names may be abbreviated.")
+    group_rp.add_argument(
         "-r", "--remote-preset", nargs='+', type=str, metavar=("PRESET", "ROOM"),
         help="activate remote PRESET for ROOM(s). Activates preset globally \
         if ROOM is omitted.")
@@ -1363,75 +5501,302 @@ if __name__ == "__main__": # {{{1
     group_rp.add_argument(
         "--define-remote-preset", nargs=2, type=str, metavar=("NAME", "ROOM"),
         help="define remote preset NAME for ROOM.")
+
+    # Recording and replay
+    group_rec = parser.add_argument_group(title="recording and replay")
+    group_rec.add_argument(
+        "--record", type=str, metavar="FILE",
+        help="append every message from the broker to log FILE until \
+        interrupted")
+    group_rec.add_argument(
+        "--replay", type=str, metavar="FILE",
+        help="publish the messages recorded in log FILE")
+    group_rec.add_argument(
+        "--speed", type=float, default=1.0, metavar="FACTOR",
+        help="speed up replay and audio files by FACTOR (0 = as fast as \
+        possible)")
+
+    # Audio
+    group_au = parser.add_argument_group(title="audio-reactive lights")
+    group_au.add_argument(
+        "--audio", nargs='+', type=str, metavar=("FILE", "ROOM"),
+        help="let the lights of ROOM(s) (default: all) react to the WAV FILE \
+        or raw audio ('-' for stdin, see README)")
+    group_au.add_argument(
+        "--fps", type=float, metavar="N",
+        help="send at most N frames per second (default: 25, limited by the \
+        rate limit of the lights)")
+
+    # Simulator
+    group_sim = parser.add_argument_group(title="simulator",
+        description="Mimic AutoC4 and its MQTT broker for testing without \
+        the club, eg. with '--broker localhost:1884'.")
+    group_sim.add_argument(
+        "--simulate", type=str, metavar="[HOST:]PORT",
+        help="run a simulated AutoC4 broker listening on PORT")
+    group_sim.add_argument(
+        "--latency", type=float, default=0, metavar="MS",
+        help="delay every packet received by MS milliseconds")
+    group_sim.add_argument(
+        "--loss", type=float, default=0, metavar="PERCENT",
+        help="drop PERCENT of all published messages")
+    group_sim.add_argument(
+        "--clients", type=int, default=0, metavar="N",
+        help="connect N idle clients subscribed to every topic")
     args = parser.parse_args()
 
-    # Debug, gate, status and shutdown.
+    # Debug and broker settings.
     if args.debug:
         C4Interface.debug = True
-    if args.status:
-        status = C4Interface().status()
-        print("Club is", status)
-    if args.gate:
-        C4Interface().open_gate()
-    if args.shutdown:
-        if args.shutdown >= 2:
-            C4Interface().shutdown(force=True)
-        else:
-            C4Interface().shutdown()
-    if args.cyberalert:
-        C4Interface().cyberalert(args.cyberalert[0])
-
-    # Kitchenlight
-    if args.list_kl_modes:
-        Kitchenlight().list_available()
-    if args.kl_mode:
-        kl = Kitchenlight()
-        if len(args.kl_mode) == 1:
-            kl.set_mode(args.kl_mode[0])
-        else:
-            kl.set_mode(args.kl_mode[0], args.kl_mode[1:])
-
-    # Colorscheme
-    if args.store_as:
-        ColorScheme().store(args.store_as)
-    presets = {} # Store and reuse initialized presets.
-    if args.w_color:
-        if args.w_color not in presets:
-            presets[args.w_color] = ColorScheme(args.w_color)
-        Wohnzimmer().set_colorscheme(presets[args.w_color])
-    if args.p_color:
-        if args.p_color not in presets:
-            presets[args.p_color] = ColorScheme(args.p_color)
-        Plenarsaal().set_colorscheme(presets[args.p_color])
-    if args.f_color:
-        if args.f_color not in presets:
-            presets[args.f_color] = ColorScheme(args.f_color)
-        Fnordcenter().set_colorscheme(presets[args.f_color])
-    if args.list_presets:
-        ColorScheme().list_available()
-
-    # Light switches
-    if args.w_switch != None:
-        Wohnzimmer().light_switch(args.w_switch)
-    if args.p_switch != None:
-        Plenarsaal().light_switch(args.p_switch)
-    if args.f_switch != None:
-        Fnordcenter().light_switch(args.f_switch)
-    if args.k_switch != None:
-        Keller().light_switch(args.k_switch)
+    C4Interface().load_config()
+    if args.broker:
+        # Talk to the given broker only.
+        C4Interface.broker, C4Interface.port = C4Interface()._parse_endpoint(args.broker)
+        C4Interface.mirrors = []
+    if args.qos is not None:
+        C4Interface.qos = args.qos
+    if args.window:
+        C4Interface.window = args.window
+    # Keep snapshots for --undo of one-shot and batch command lines only, not
+    # of automated, replayed or remote changes.
+    long_running = (args.watch or args.rules or args.schedule is not None
+                    or args.serve or args.coprocess or args.simulate
+                    or args.record or args.replay or args.audio)
+    C4Interface.history = not long_running
+    def execute(args):
+        """ Do what the command line options in args ask for. """
+
+        # Gate, status and shutdown.
+        if args.status:
+            status = C4Interface().status()
+            print("Club is", status)
+        if args.gate:
+            C4Interface().open_gate()
+        if args.shutdown:
+            if args.shutdown >= 2:
+                C4Interface().shutdown(force=True)
+            else:
+                C4Interface().shutdown()
+        if args.cyberalert:
+            C4Interface().cyberalert(args.cyberalert[0])
+        if args.undo:
+            if not History().undo(args.undo): sys.exit(1)
+
+        # Kitchenlight
+        if args.list_kl_modes:
+            Kitchenlight().list_available()
+        if args.kl_mode:
+            kl = Kitchenlight()
+            if len(args.kl_mode) == 1:
+                kl.set_mode(args.kl_mode[0])
+            else:
+                kl.set_mode(args.kl_mode[0], args.kl_mode[1:])
+
+        # Colorscheme
+        if args.import_presets is not None or args.export_presets:
+            config_dir = ColorScheme()._get_config_dir()
+            if not config_dir: sys.exit(1)
+            library = ColorScheme()._get_library(config_dir,
+                create=args.import_presets is not None)
+            if args.import_presets is not None:
+                count = library.import_files(config_dir, args.import_presets)
+                print("Imported {} presets into \"{}\"".format(count, library.path))
+            if args.export_presets:
+                if library is None:
+                    print("Error: there is no preset library!", file=sys.stderr)
+                    sys.exit(1)
+                count = library.export_files(config_dir)
+                print("Exported {} presets to \"{}\"".format(count, config_dir))
+        current = None
+        if args.from_preset:
+            current = ColorScheme(args.from_preset)
+            # Errors have already been printed.
+            if not current: sys.exit(1)
+        if args.store_as:
+            ColorScheme().store(args.store_as, current)
+        if args.a_color:
+            # Shorthand for all rooms, unless a room has been given explicitly.
+            args.w_color = args.w_color or args.a_color
+            args.p_color = args.p_color or args.a_color
+            args.f_color = args.f_color or args.a_color
+        presets = {} # Store and reuse initialized presets.
+        schemes = [] # (room, ColorScheme) tuples to apply in a single batch.
+        for room, preset in ((Wohnzimmer, args.w_color),
+                             (Plenarsaal, args.p_color),
+                             (Fnordcenter, args.f_color)):
+            if preset:
+                if preset not in presets:
+                    presets[preset] = ColorScheme(preset)
+                schemes.append((room, presets[preset]))
+        if schemes:
+            apply_scheme(schemes, minimal=args.minimal or current is not None,
+                         current=current, stagger=args.stagger)
+        if args.list_presets:
+            ColorScheme().list_available()
+
+        # Light switches
+        if args.w_switch != None:
+            Wohnzimmer().light_switch(args.w_switch)
+        if args.p_switch != None:
+            Plenarsaal().light_switch(args.p_switch)
+        if args.f_switch != None:
+            Fnordcenter().light_switch(args.f_switch)
+        if args.k_switch != None:
+            Keller().light_switch(args.k_switch)
+
+        # Remote presets
+        if args.list_remote:
+            RemotePresets().list_available(args.list_remote.lower())
+        if args.remote_preset:
+            if len(args.remote_preset) == 1:
+                RemotePresets().apply_preset(args.remote_preset[0].strip())
+            else:
+                RemotePresets().apply_preset(args.remote_preset[0].strip(),
+                                             args.remote_preset[1:])
+        if args.define_remote_preset:
+            RemotePresets().define_preset(args.define_remote_preset[0].strip(),
+                                         args.define_remote_preset[1].strip())
+
+        # Live view
+        if args.watch:
+            Dashboard().run()
+
+        # Automation rules
+        if args.rules:
+            engine = RulesEngine()
+            if not engine.load(args.rules): sys.exit(1)
+            engine.run(verbose=args.verbose)
+
+        # Latency probes
+        if args.probe:
+            if not Prober(args.probe, args.interval / 1000).run(
+                    verbose=args.verbose):
+                sys.exit(1)
+
+        # Co-process
+        if args.coprocess:
+            Coprocess().run()
+
+        # Scheduler
+        if args.schedule is not None:
+            if not args.schedule:
+                import os
+                config_dir = ColorScheme()._get_config_dir()
+                if not config_dir: sys.exit(1)
+                args.schedule = os.path.join(config_dir, Scheduler.filename)
+            scheduler = Scheduler()
+            if not scheduler.load(args.schedule): sys.exit(1)
+            scheduler.run(verbose=args.verbose)
+
+        # HTTP gateway
+        if args.serve:
+            host, sep, port = args.serve.rpartition(':')
+            if not port.isdigit():
+                print("Error: invalid port \"{}\"!".format(port), file=sys.stderr)
+                sys.exit(1)
+            Gateway(host or "localhost", int(port)).run(verbose=args.verbose)
+
+        # Simulator
+        if args.simulate:
+            host, sep, port = args.simulate.rpartition(':')
+            if not port.isdigit():
+                print("Error: invalid port \"{}\"!".format(port), file=sys.stderr)
+                sys.exit(1)
+            Simulator(host or "localhost", int(port), args.latency / 1000,
+                      args.loss / 100, args.clients, args.verbose).run()
+
+        # Audio-reactive lights
+        if args.audio:
+            try:
+                rooms = [Action._expand_room(r) for r in args.audio[1:]]
+            except ValueError as error:
+                print("Error: {}".format(error), file=sys.stderr)
+                sys.exit(1)
+            if not AudioEngine(rooms, args.fps).run(args.audio[0], args.speed,
+                                                    verbose=args.verbose):
+                sys.exit(1)
+
+        # Recording and replay
+        if args.replay:
+            SceneLog(args.replay).replay(args.speed, verbose=args.verbose)
+        if args.record:
+            if not SceneLog(args.record).record(verbose=args.verbose):
+                sys.exit(1)
+
+    # Metrics are served in the background, measuring everything else.
+    if args.metrics:
+        host, sep, port = args.metrics.rpartition(':')
+        if not port.isdigit():
+            print("Error: invalid port \"{}\"!".format(port), file=sys.stderr)
+            sys.exit(1)
+        exporter = Exporter(host or "localhost", int(port))
+        exporter.start(verbose=args.verbose)
+
+    # Batch mode
+    if args.batch:
+        import shlex
+        from time import sleep
 
-    # Remote presets
-    if args.list_remote:
-        RemotePresets().list_available(args.list_remote.lower())
-    if args.remote_preset:
-        if len(args.remote_preset) == 1:
-            RemotePresets().apply_preset(args.remote_preset[0].strip())
-        else:
-            RemotePresets().apply_preset(args.remote_preset[0].strip(),
-                                         args.remote_preset[1:])
-    if args.define_remote_preset:
-        RemotePresets().define_preset(args.define_remote_preset[0].strip(),
-                                     args.define_remote_preset[1].strip())
+        try:
+            fd = sys.stdin if args.batch == '-' else open(args.batch)
+        except OSError as error:
+            print("Error: could not read batch file: {}".format(error),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        # Use a single connection and send everything between sleeps and
+        # waits as a single batch.
+        c4 = C4Interface()
+        c4.connect()
+        c4.hold()
+        try:
+            for number, line in enumerate(fd, 1):
+                if line.lstrip()[:1] == '#': continue
+                words = shlex.split(line)
+                if not words: continue
+
+                if words[0] in ("sleep", "wait"):
+                    c4.flush()
+                    c4.wait_for_publish(c4.timeout)
+                    if words[0] == "sleep":
+                        try:
+                            sleep(float(words[1]))
+                        except (IndexError, ValueError):
+                            print("Error in line {}: sleep needs a number of \
+seconds!".format(number), file=sys.stderr)
+                            sys.exit(1)
+                    c4.hold()
+                    continue
+
+                try:
+                    line_args = parser.parse_args(words)
+                except SystemExit:
+                    print("Error in line {} of \"{}\"!".format(number, args.batch),
+                          file=sys.stderr)
+                    raise
+                # Settings of the connection and functions running until
+                # interrupted only make sense on the command line.
+                for dest in ("debug", "broker", "qos", "window", "batch",
+                             "watch", "rules", "schedule", "serve", "coprocess",
+                             "metrics", "probe", "record", "replay", "audio",
+                             "simulate"):
+                    if getattr(line_args, dest) != parser.get_default(dest):
+                        print("Error in line {} of \"{}\": --{} is not allowed \
+in batch files!".format(number, args.batch, dest), file=sys.stderr)
+                        sys.exit(1)
+                execute(line_args)
+
+            c4.flush()
+            c4.wait_for_publish(c4.timeout)
+        finally:
+            c4.disconnect()
+    else:
+        execute(args)
+
+    # Keep serving metrics, unless they were measuring another long running
+    # function which has just been interrupted.
+    if args.metrics and not (args.batch or long_running):
+        exporter.run(verbose=args.verbose)
 
     # No or no useful command line options?
     if len(sys.argv) <= 1 or len(sys.argv) == 2 and args.debug:
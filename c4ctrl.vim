@@ -1,12 +1,13 @@
 " c4ctrl.vim: This Vim plugin makes some functionality of the c4ctrl command
 "             line utility available from within Vim.
 "
-" Last Change: 2017 Apr 16
+" Last Change: 2026 Oct 19
 " Maintainer: Shy
 " License: This file is placed in the public domain.
 "
 " Usage: C4ctrl [get | kitchentext [REGISTER] | open PRESET |
-"                set [w] [p] [f] [-magic] | write PRESET]
+"                preview [w] [p] [f] | set [w] [p] [f] [-minimal] |
+"                write PRESET]
 
 if exists("g:loaded_c4ctrl")
   finish
@@ -42,10 +43,123 @@ function s:FindConfigDir() " {{{1
 endfunction " }}}1
 
 
+" ************************************************************************** "
+" Utility function to be called after a preset has been loaded.              "
+" ************************************************************************** "
+function s:SynHighlight() " {{{1
+
+  syn clear
+  " Match topics
+  syn match Identifier "^\s*[[:alnum:]/]\+\ze\s*="
+  " Match color values with 3 digits
+  syn match Number "=\s*\zs\%(\s*\x\)\{3}"
+  " Match color values with 6 digits
+  syn match Number "=\s*\zs\%(\s*\x\)\{6}"
+  " Match comments
+  syn match Comment "^\s*#.*" 
+  " Match error: too few digits
+  syn match Error "=\s*\zs\x\{1,2}\s*$"
+  " Match error: invalid chars as digit
+  syn match Error "=\s*\zs.*[^[:blank:][:xdigit:]]\+.*"
+  "syn match Error "=\s*\zs.*\%(\S\&\X\)\+.*"
+
+  " Move the cursor somewhere more practical.
+  call cursor(1,1)
+  call search("^[^#].*=[ \t]*[0-9a-fA-F]", 'eW')
+
+endfunction " }}}1
+
+
+" ************************************************************************** "
+" Co-process: If Vim has been compiled with +job and +channel, requests are  "
+" sent to a long running 'c4ctrl --coprocess' as lines of JSON and answered  "
+" asynchronously, so Vim does not freeze while waiting for the network.      "
+" Without job support C4ctrl() falls back to calling c4ctrl synchronously.   "
+" ************************************************************************** "
+let s:requests = {} " Pending requests by id.
+let s:last_request = 0
+
+function s:CoprocessWarn(message) " {{{1
+
+  echohl WarningMsg
+  echomsg a:message
+  echohl None
+
+endfunction " }}}1
+
+" Start the co-process unless it is already running. Returns 1 on success
+" and 0 if job support is missing or the co-process could not be started.
+function s:Coprocess(executable) " {{{1
+
+  if !has("job") || !has("channel")
+    return 0
+  endif
+  if exists("s:job") && job_status(s:job) == "run"
+    return 1
+  endif
+
+  let s:requests = {}
+  let s:job = job_start([a:executable, "--coprocess"], {
+        \ "mode": "nl",
+        \ "out_cb": function("s:OnResponse"),
+        \ "err_cb": function("s:OnError")})
+  if job_status(s:job) != "run"
+    call s:CoprocessWarn("Error: could not start ".a:executable." --coprocess!")
+    unlet s:job
+    return 0
+  endif
+  return 1
+
+endfunction " }}}1
+
+" Send request (a dictionary) to the co-process. Context is kept until the
+" responce arrives and tells s:OnResponse() what to do with it.
+function s:Request(request, context) " {{{1
+
+  let s:last_request += 1
+  let a:request.id = s:last_request
+  let s:requests[s:last_request] = a:context
+  call ch_sendraw(job_getchannel(s:job), json_encode(a:request)."\n")
+
+endfunction " }}}1
+
+function s:OnResponse(channel, message) " {{{1
+
+  try
+    let responce = json_decode(a:message)
+    let context = remove(s:requests, responce.id)
+  catch
+    call s:CoprocessWarn("c4ctrl: ".a:message)
+    return
+  endtry
+
+  if has_key(responce, "error")
+    call s:CoprocessWarn("c4ctrl: ".context.command." failed: ".responce.error)
+
+  elseif context.command == "get"
+    execute context.mods "new"
+    call setline(1, split(responce.preset, "\n"))
+    call s:SynHighlight()
+    set nomodified " Mark as unmodified.
+
+  elseif context.command == "set" && !context.silent
+    echo printf("c4ctrl: %d messages sent", responce.sent)
+  endif
+
+endfunction " }}}1
+
+function s:OnError(channel, message) " {{{1
+
+  call s:CoprocessWarn("c4ctrl: ".a:message)
+
+endfunction " }}}1
+
+
 " ************************************************************************** "
 " Make some functionality of the 'c4ctrl' command line utility available     "
 " from within Vim.                                                           "
-" Available commands are 'get', 'kitchentext', 'open', 'set' and 'write'.    "
+" Available commands are 'get', 'kitchentext', 'open', 'preview', 'set' and  "
+" 'write'.                                                                   "
 " Arguments:                                                                 "
 "   prev_cursor_pos   -- cursor position as returned by getcurpos()          "
 "   mods              -- modifiers (:command variable <f-mods>)              "
@@ -73,32 +187,6 @@ function C4ctrl(prev_cursor_pos, mods, first_line, last_line, command, ...) rang
 
     endfunction " }}}2
 
-    " ********************************************************************** "
-    " Utility function to be called after a preset has been loaded.          "
-    " ********************************************************************** "
-    function! s:SynHighlight() " {{{2
-  
-      syn clear
-      " Match topics
-      syn match Identifier "^\s*[[:alnum:]/]\+\ze\s*="
-      " Match color values with 3 digits
-      syn match Number "=\s*\zs\%(\s*\x\)\{3}"
-      " Match color values with 6 digits
-      syn match Number "=\s*\zs\%(\s*\x\)\{6}"
-      " Match comments
-      syn match Comment "^\s*#.*" 
-      " Match error: too few digits
-      syn match Error "=\s*\zs\x\{1,2}\s*$"
-      " Match error: invalid chars as digit
-      syn match Error "=\s*\zs.*[^[:blank:][:xdigit:]]\+.*"
-      "syn match Error "=\s*\zs.*\%(\S\&\X\)\+.*"
-
-      " Move the cursor somewhere more practical.
-      call cursor(1,1)
-      call search("^[^#].*=[ \t]*[0-9a-fA-F]", 'eW')
-
-    endfunction " }}}2
-  
     " Check if we can execute c4ctrl or c4ctrl.py and modify the variable
     " s:c4ctrl accordingly if needed.
     if !executable(s:c4ctrl) " {{{2
@@ -117,6 +205,11 @@ function C4ctrl(prev_cursor_pos, mods, first_line, last_line, command, ...) rang
     " *************************************************** "
     if stridx("get", a:command) == 0 " {{{2
 
+      if s:Coprocess(s:c4ctrl)
+        call s:Request({"command": "get"}, {"command": "get", "mods": a:mods})
+        return
+      endif
+
       execute a:mods "new"
       silent execute "0 read !" s:c4ctrl "-o -"
       if v:shell_error == 0
@@ -218,35 +311,70 @@ function C4ctrl(prev_cursor_pos, mods, first_line, last_line, command, ...) rang
       call s:SynHighlight()
     " }}}2
   
+    " ****************************************************************** "
+    " Command 'preview': Toggle applying the buffer on every write.      "
+    " ****************************************************************** "
+    elseif stridx("preview", a:command) == 0 " {{{2
+
+      augroup C4ctrlPreview
+        autocmd! * <buffer>
+        if exists("b:c4ctrl_preview")
+          unlet b:c4ctrl_preview
+          echo "Preview off."
+        else
+          let b:c4ctrl_preview = map(copy(a:000), 'string(v:val)')
+          " Only lights changed since the last preview are sent.
+          execute "autocmd BufWritePost <buffer> silent call C4ctrl(getcurpos(), '', 1, line('$'), 'set', '-minimal'"
+                \ .join([""] + b:c4ctrl_preview, ", ").")"
+          echo "Preview on. Changes will be applied on every write."
+        endif
+      augroup END
+    " }}}2
+
     " *********************************************** "
     " Command 'set': Apply range or buffer as preset. "
     " *********************************************** "
     elseif stridx("set", a:command) == 0 " {{{2
 
-      " Let's start by building a command line.
-      let command_line = s:c4ctrl
-      let rooms_given = 0
-  
-      for i in range(a:0)
-        let  arg = a:000[i]
+      let rooms = []
+      let minimal = 0
+      for arg in a:000
         for room in ["wohnzimmer", "plenarsaal", "fnordcenter"]
           if stridx(room, arg) == 0
-            let command_line = printf("%s -%s -", command_line, arg[0])
-            let rooms_given = 1
+            call add(rooms, arg[0])
           endif
         endfor
-        if stridx("-magic", arg) == 0
-          let command_line = printf("%s --magic", command_line)
+        if stridx("-minimal", arg) == 0
+          let minimal = 1
         endif
       endfor
-  
-      if rooms_given == 0
-        " If no room is given, set colors for all rooms.
-        let command_line .= " -w - -p - -f -"
+
+      if s:Coprocess(s:c4ctrl)
+        " With minimal set, the co-process only sends lights which changed
+        " since the last 'set'. If no room is given, it sets all rooms.
+        call s:Request({
+              \ "command": "set",
+              \ "preset": join(getline(a:first_line, a:last_line), "\n"),
+              \ "rooms": rooms,
+              \ "minimal": minimal ? v:true : v:false},
+              \ {"command": "set", "silent": minimal})
+      else
+        " Let's start by building a command line.
+        let command_line = s:c4ctrl
+        for room in rooms
+          let command_line = printf("%s -%s -", command_line, room)
+        endfor
+        if rooms == []
+          " If no room is given, set colors for all rooms.
+          let command_line .= " -a -"
+        endif
+        if minimal
+          let command_line .= " --minimal"
+        endif
+
+        silent let ret = system(command_line, getline(a:first_line, a:last_line))
       endif
   
-      silent let ret = system(command_line, getline(a:first_line, a:last_line))
-  
       " Restore cursor position.
       call setpos('.', a:prev_cursor_pos)
     " }}}2
@@ -283,7 +411,7 @@ function C4ctrl(prev_cursor_pos, mods, first_line, last_line, command, ...) rang
     " **************************** "
     else " {{{2
       call s:Warn("Unknown command: ".a:command)
-      echo "Valid commands are get, kitchentext, open, set and write"
+      echo "Valid commands are get, kitchentext, open, preview, set and write"
     endif
   
     " Echo return if shell exited with an error.
@@ -296,7 +424,6 @@ function C4ctrl(prev_cursor_pos, mods, first_line, last_line, command, ...) rang
   " {{{ Clean up environment after C4ctrl().
   finally
     unlet! s:c4ctrl s:config_dir
-    delfunction s:SynHighlight
     delfunction s:Warn
   endtry
   " }}}
@@ -330,7 +457,7 @@ function s:C4ctrlCompletion(ArgLead, CmdLine, CursorPos) " {{{1
       " ************************** "
       " Complete the prime command "
       " ************************** "
-      return "get\nkitchentext\nopen\nset\nwrite"
+      return "get\nkitchentext\nopen\npreview\nset\nwrite"
     endif
 
     if stridx("open", get(command_line, command_index + 1)) == 0 || (len(command_line) == command_index + 1 && a:ArgLead == command_name)
@@ -366,7 +493,13 @@ function s:C4ctrlCompletion(ArgLead, CmdLine, CursorPos) " {{{1
       " ************************** "
       " Complete the 'set' command "
       " ************************** "
-      return "wohnzimmer\nplenarsaal\nfnordcenter\n-magic"
+      return "wohnzimmer\nplenarsaal\nfnordcenter\n-minimal"
+
+    elseif stridx("preview", get(command_line, command_index + 1)) == 0
+      " ****************************** "
+      " Complete the 'preview' command "
+      " ****************************** "
+      return "wohnzimmer\nplenarsaal\nfnordcenter"
 
     elseif stridx("write", get(command_line, command_index + 1)) == 0 || (len(command_line) == command_index + 1 && a:ArgLead == command_name)
       " **************************** "